@@ -0,0 +1,97 @@
+"""
+Compare the CSV engines used to read raw ITSS files.
+
+Writes a synthetic year of data in the raw ITSS layout and times ``read_raw``
+with each engine, reporting rows per second. First checks that each engine
+gives the same frame reading the file in chunks as reading it whole, with
+values that only turn up in the last chunk (a mistyped ZIP, a text beat and
+a spelled-out code).
+
+    python benchmarks/csv_engine.py --rows 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from itssutils.loader.decoder import DEFAULT_COLUMNS
+from itssutils.loader.load_raw import ENGINES, read_raw, process_data, concat_frames
+
+AGENCIES = ['Chicago Police', 'Illinois State Police', 'Evanston Police',
+            'Oak Park Police', 'Naperville Police']
+
+
+def make_year(rows, seed=0):
+    """A frame of random codes laid out like a raw ITSS file"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({col: rng.integers(0, 3, rows) for col in DEFAULT_COLUMNS})
+    df['AgencyName'] = rng.choice(AGENCIES, rows)
+    df['AgencyCode'] = rng.integers(10000, 11000, rows)
+    dates = pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D')
+    df['DateOfStop'] = dates.strftime('%m/%d/%Y')
+    df['TimeOfStop'] = (pd.Series(rng.integers(0, 24, rows)).map('{:02d}'.format) + ':'
+                        + pd.Series(rng.integers(0, 60, rows)).map('{:02d}'.format))
+    df['DurationOfStop'] = rng.integers(1, 60, rows)
+    df['ZIP'] = rng.choice(['60601', '60202', '61820', 'N/A'], rows)
+    df['VehicleMake'] = rng.choice(['FORD', 'TOYT', 'HOND', 'N/A'], rows)
+    df['VehicleYear'] = rng.integers(1990, 2018, rows)
+    df['DriversYearofBirth'] = rng.integers(1930, 2000, rows)
+    df['DriverRace'] = rng.integers(1, 7, rows)
+    df['ReasonForStop'] = rng.integers(1, 5, rows)
+    df['ResultOfStop'] = rng.integers(1, 4, rows)
+    df['BeatLocationOfStop'] = rng.choice(['12', '07', '0031'], rows)
+    # Values the first chunks don't have
+    df.loc[rows - 1, 'ZIP'] = '6O601'
+    df.loc[rows - 1, 'BeatLocationOfStop'] = 'A1'
+    df.loc[rows - 1, 'ReasonForStop'] = 'Equipment'
+    return df
+
+
+def check_chunks(filename, engine, chunksize):
+    """Check that reading and processing filename in chunks gives the same
+       frame, with the same types, as reading it whole"""
+    full = process_data(read_raw(filename, 2017, engine=engine), verbose=False)
+    chunked = concat_frames([process_data(chunk, verbose=False)
+                             for chunk in read_raw(filename, 2017, chunksize=chunksize,
+                                                   engine=engine)])
+    # Categories can come in a different order
+    pd.testing.assert_frame_equal(chunked, full, check_categorical=False)
+
+
+def time_engine(filename, engine, repeat):
+    """Best time in seconds to read filename with the given engine"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        read_raw(filename, 2017, engine=engine)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, '2017_ITSS_Data.txt')
+        make_year(args.rows).to_csv(filename, sep='~', index=False)
+        size = os.path.getsize(filename) / 2 ** 20
+        print(f'{args.rows} rows, {size:.1f} MB')
+
+        for engine in ENGINES:
+            check_chunks(filename, engine, chunksize=max(args.rows // 4, 1))
+        print('Chunked reads match whole reads.')
+
+        for engine in ENGINES:
+            seconds = time_engine(filename, engine, args.repeat)
+            print(f'{engine:>8}: {seconds:.2f} s, {args.rows / seconds:,.0f} rows/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,2 @@
-name = "itssutils"
\ No newline at end of file
+name = "itssutils"
+__version__ = '0.0.1'
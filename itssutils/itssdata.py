@@ -10,8 +10,10 @@ import pandas as pd
 import pickle
 
 from .loader.load_raw import load_data, load_multiple_years
+from .loader.cache import get_load_fingerprint
+from .loader.compactor import compact_dtypes, memory_report
 from .viz import timeseries, scatterplot, zhist, barplot, ratioplot
-from .metrics import metrics, zscores, names
+from .metrics import metrics, zscores, names, cache
 
 
 class RawITSSData(object):
@@ -19,16 +21,40 @@ class RawITSSData(object):
 
     Attributes:
         raw_data_df (pd.DataFrame): raw dataframe
+        memory_report (pd.DataFrame): bytes per column before and after the last compaction
+        processing_report (pd.DataFrame): time and memory taken by each processing
+            stage of the last profiled load (see loader.pipeline.run_stages)
+        data_fingerprint (str): fingerprint of the loaded data by the raw files and
+            processing pipeline (see loader.cache.get_load_fingerprint)
+
+    Cached metrics are found by fingerprints taken once, when the data is loaded
+    or its columns are first hashed, which can't see raw_data_df being changed
+    in place. Call :meth:`mark_modified` after doing so (or assign a new frame).
     """
 
-    def load_single_year(self, year, filename, fast=True, save=False):
+    memory_report = None
+    processing_report = None
+    data_fingerprint = None
+    # The frame the fingerprints are for, and its column -> fingerprint
+    _fingerprinted_df = None
+    _column_fingerprints = None
+
+    def load_single_year(self, year, filename, fast=True, save=False, chunksize=None,
+                         columns=None, compact=True, engine='pandas', profile=False):
         """ Load a single year of raw data
 
         Args:
             year (int): The year of interest
             filename (str): The filename containing raw ITSS data
-            fast (bool): Whether to load from pre-processed pickle file
-            save (bool): Whether to save to a pickle file
+            fast (bool): Whether to load from the pre-processed (Feather) cache,
+                rebuilding it if the raw file or processing code has changed
+            save (bool): Whether to save to the pre-processed cache
+            chunksize (int): If given, read and process the file this many rows at a time
+            columns (list of str): If given, only keep these columns
+            compact (bool): Whether to shrink the columns to compact dtypes
+            engine (str): CSV parser for raw files, 'pandas' or 'arrow' (multithreaded)
+            profile (bool): Whether to record the time and memory each processing
+                stage takes (see :meth:`get_processing_report`)
 
         Returns:
             None
@@ -37,19 +63,117 @@ class RawITSSData(object):
             >>> rid.load_single_year(2016, '2016_ITSS_Data.txt')
 
         """
-        self.raw_data_df = load_data(year, filename, fast=fast, save=save)
-
-    def load_multiple_years(self, year_file_list, fast=True, save=False):
+        loaded = load_data(year, filename, fast=fast, save=save, chunksize=chunksize,
+                           columns=columns, engine=engine, profile=profile)
+        if profile:
+            loaded, self.processing_report = loaded
+        self.raw_data_df = loaded
+        self._set_fingerprint([(year, filename)], columns)
+        if compact:
+            self.compact()
+
+    def load_multiple_years(self, year_file_list, fast=True, save=False, chunksize=None,
+                            columns=None, n_workers=1, compact=True, engine='pandas',
+                            profile=False):
         """Load multiple years worth of raw data into a single object
 
         Args:
             year_file_list (list): List of tuples of the format (year, filename)
+            chunksize (int): If given, read and process each file this many rows at a time
+            columns (list of str): If given, only keep these columns
+            n_workers (int): Number of processes used to load years concurrently
+            compact (bool): Whether to shrink the columns to compact dtypes
+            engine (str): CSV parser for raw files, 'pandas' or 'arrow' (multithreaded)
+            profile (bool): Whether to record the time and memory each processing
+                stage takes (see :meth:`get_processing_report`)
 
         Example:
             >>> yf_list = [(2012, '2012_ITSS_Data.txt'), (2013, '2013_ITSS_Data.txt')]
             >>> rid.load_multiple_years(yf_list)
+
+            >>> # Only load what is needed for search rates
+            >>> rid.load_multiple_years(yf_list, columns=['AgencyName', 'DriverRace',
+            ...                                           'SearchConducted', 'IllegalFound'])
+
+            >>> # Load the years in parallel on 8 cores
+            >>> rid.load_multiple_years(yf_list, n_workers=8)
         """
-        self.raw_data_df = load_multiple_years(year_file_list, fast=fast, save=save)
+        loaded = load_multiple_years(year_file_list, fast=fast, save=save,
+                                     chunksize=chunksize, columns=columns,
+                                     n_workers=n_workers, engine=engine, profile=profile)
+        if profile:
+            loaded, self.processing_report = loaded
+        self.raw_data_df = loaded
+        self._set_fingerprint(year_file_list, columns)
+        if compact:
+            self.compact()
+
+    def _set_fingerprint(self, year_file_list, columns):
+        self.data_fingerprint = get_load_fingerprint(year_file_list, columns=columns)
+        self._fingerprinted_df = self.raw_data_df
+        self._column_fingerprints = {}
+
+    def get_data_fingerprint(self):
+        """Return the fingerprint of the loaded data, or None if raw_data_df has
+        been replaced or marked modified since it was loaded"""
+        if self._fingerprinted_df is not self.raw_data_df:
+            return None
+        return self.data_fingerprint
+
+    def mark_modified(self):
+        """Forget the fingerprints of raw_data_df after changing it in place, so
+        that metrics cached for the data as it was aren't returned for it
+
+        Example:
+            >>> rid.raw_data_df.loc[rid.raw_data_df.AgencyName == 'X', 'Year'] = 2016
+            >>> rid.mark_modified()
+        """
+        self.data_fingerprint = None
+        self._fingerprinted_df = self.raw_data_df
+        self._column_fingerprints = {}
+
+    def _get_cache_fingerprint(self, grouping):
+        """Fingerprint of raw_data_df for the metrics cache: the one it was
+        loaded with, or else a fingerprint of its columns, each hashed only the
+        first time"""
+        if self._fingerprinted_df is not self.raw_data_df:
+            # raw_data_df was replaced
+            self.mark_modified()
+        if self.data_fingerprint is not None:
+            return self.data_fingerprint
+        return cache.get_data_fingerprint(self.raw_data_df, grouping,
+                                          column_fingerprints=self._column_fingerprints)
+
+    def compact(self):
+        """Shrink the raw data to compact dtypes (categoricals, nullable and
+        small integers) and record how much memory each column saved
+
+        Returns:
+            pd.DataFrame: The memory report (see :meth:`get_memory_report`)
+        """
+        before = self.raw_data_df.memory_usage(deep=True, index=False)
+        compact_dtypes(self.raw_data_df)
+        after = self.raw_data_df.memory_usage(deep=True, index=False)
+        self.memory_report = memory_report(before, after)
+        return self.memory_report
+
+    def get_memory_report(self):
+        """Return the bytes used by each column before and after compaction
+
+        Example:
+            >>> rid.get_memory_report().head()
+        """
+        return self.memory_report
+
+    def get_processing_report(self):
+        """Return the time and memory taken by each processing stage of the last
+        load with profile on (None for years loaded from the pre-processed cache)
+
+        Example:
+            >>> rid.load_single_year(2016, '2016_ITSS_Data.txt', fast=False, profile=True)
+            >>> rid.get_processing_report()[['seconds', 'peak', 'peak_rss']]
+        """
+        return self.processing_report
 
     def get_collected_data(self):
         """Get a list of all the categories of data collected and processed"""
@@ -115,7 +239,7 @@ class RawITSSData(object):
         # Group by a given category if chosen
         if group:
             group = [group] if not isinstance(group, list) else group
-            ts = ts[group].groupby(group)
+            ts = ts[group].groupby(group, observed=True)
         else:
             ts = ts.DateOfStop
 
@@ -132,6 +256,17 @@ class ITSSMetrics(object):
         raw_df (pd.DataFrame): The dataframe of raw ITSS data
         metrics (pd.DataFrame): The dataframe of calculated metrics
         grouping (list of str): The grouping of calculated metrics
+        grouping_sets (list of tuples): The combinations of grouping columns
+            that were calculated
+        counts (:class:`GroupCounts`): The counts the metrics were made from, which
+            new data can be added to (None for the loop engine)
+        population_csv (str or path): Filename of the population demographic csv
+            the metrics were calculated with
+        intervals (tuple): (method, confidence) of the confidence intervals of the
+            rates, or None without them
+
+    As with :class:`RawITSSData`, call :meth:`mark_modified` after changing raw_df
+    in place, or the metrics cache can return metrics for the data as it was.
     """
 
     def __init__(self, itss_data=None):
@@ -145,16 +280,49 @@ class ITSSMetrics(object):
             self.raw_df = itss_data.raw_data_df
         else:
             self.raw_df = None
+        # Fingerprints for the cache come from itss_data while raw_df is its frame,
+        # else from (frame, column -> fingerprint), so each column is hashed once
+        self._itss_data = itss_data
+        self._column_fingerprints = (self.raw_df, {})
 
         self.grouping = None
+        self.grouping_sets = None
         self.metrics = None
-
-    def calculate_metrics(self, grouping, population_csv=None):
+        self.counts = None
+        self.population_csv = None
+        self.intervals = None
+
+    def calculate_metrics(self, grouping, population_csv=None, engine='vectorized',
+                          grouping_sets=None, n_workers=1, sparse=False, metric_names=None,
+                          cache_dir=None, cache_max_bytes=cache.MAX_CACHE_BYTES,
+                          intervals=None, confidence=0.95):
         """ Calculate the metrics, grouping by different items
 
         Args:
             grouping (str or list of str): Columns by which to group the data
             population_csv (str or path): Filename of population demographic csv
+            engine (str): 'vectorized' to count all groups at once, or 'loop' to
+                calculate each group in turn (slow, but the original method)
+            grouping_sets (list of tuples): Only calculate these combinations of the
+                grouping columns, with () for the overall metrics (default: all of them)
+            n_workers (int): Number of processes to count with (vectorized engine only)
+            sparse (bool): Store the Reason-, Result- and move- metrics, which most
+                groups don't have, as sparse columns
+            metric_names (list of str): Only calculate these metrics (or families of
+                metrics, by prefix, e.g. 'Reason-') at first, along with any others
+                that come from the same counts; the rest are calculated when they're
+                first plotted or asked for (vectorized engine only)
+            cache_dir (str or path): Directory to cache the metrics in, so calculating
+                them again for the same data, grouping and population returns the
+                cached metrics (default: no caching). Changes made to raw_df in
+                place aren't seen without :meth:`mark_modified`
+            cache_max_bytes (int): Size of the cache, beyond which the least recently
+                used metrics are evicted
+            intervals (str): Also calculate confidence intervals of the rates, as
+                <rate>Lower and <rate>Upper columns: 'wilson' for Wilson score
+                intervals, or 'exact' for Clopper-Pearson intervals, which are
+                better for groups with few stops (default: no intervals)
+            confidence (float): Confidence level of the intervals
 
         Examples:
             >>> # Calculate the metrics for each racial group across all traffic stops
@@ -162,18 +330,178 @@ class ITSSMetrics(object):
 
             >>> # Calculate yearly metrics by driver sex for each agency
             >>> mdf = metrics_by_group(raw_data_df, ['AgencyName', 'Year', 'DriverSex'])
+
+            >>> # Only the metrics for each agency by race, and for each race overall
+            >>> met.calculate_metrics(['AgencyName', 'DriverRace'],
+            ...                       grouping_sets=[('AgencyName', 'DriverRace'), ('DriverRace',)])
+
+            >>> # Just what's needed for search rates, other metrics come later if needed
+            >>> met.calculate_metrics(['AgencyName', 'DriverRace'], metric_names=['SearchRate'])
+
+            >>> # With exact 95% confidence intervals, e.g. SearchRateLower and SearchRateUpper
+            >>> met.calculate_metrics(['AgencyName', 'DriverRace'], intervals='exact')
         """
-        self.metrics = metrics.metrics_by_group(self.raw_df,
-                                                grouping,
-                                                population_csv=population_csv)
+        if intervals is not None and intervals not in metrics.INTERVAL_METHODS:
+            raise ValueError(f'Unknown interval method {intervals}, must be one of '
+                             f'{metrics.INTERVAL_METHODS}')
+        if isinstance(grouping, str):
+            grouping = [grouping]
+        grouping_sets = metrics.get_grouping_sets(grouping, grouping_sets)
         self.grouping = grouping
+        self.grouping_sets = grouping_sets
+        self.population_csv = population_csv
+        self.intervals = None if intervals is None else (intervals, confidence)
+
+        if cache_dir is not None:
+            key = cache.get_cache_key(self.raw_df, grouping, grouping_sets, population_csv,
+                                      engine, sparse=sparse, metric_names=metric_names,
+                                      intervals=self.intervals,
+                                      data_fingerprint=self._get_data_fingerprint(grouping))
+            cached = cache.read_cached(cache_dir, key)
+            if cached is not None:
+                (self.metrics, self.counts) = cached
+                return
+
+        if engine == 'vectorized':
+            # Keep the counts, so that new data can be added to them later
+            self.counts = metrics.count_by_group(self.raw_df, grouping,
+                                                 grouping_sets=grouping_sets,
+                                                 n_workers=n_workers,
+                                                 metric_names=metric_names)
+            self.metrics = metrics.metrics_from_counts(self.counts,
+                                                       grouping,
+                                                       population_csv=population_csv,
+                                                       grouping_sets=grouping_sets,
+                                                       sparse=sparse)
+            print('Done!')
+        else:
+            self.counts = None
+            self.metrics = metrics.metrics_by_group(self.raw_df,
+                                                    grouping,
+                                                    population_csv=population_csv,
+                                                    engine=engine,
+                                                    grouping_sets=grouping_sets,
+                                                    n_workers=n_workers,
+                                                    sparse=sparse,
+                                                    metric_names=metric_names)
+        self._add_intervals()
+
+        if cache_dir is not None:
+            cache.save_cached(cache_dir, key, (self.metrics, self.counts),
+                              max_bytes=cache_max_bytes)
+
+    def _shares_raw_data(self):
+        return self._itss_data is not None and self._itss_data.raw_data_df is self.raw_df
+
+    def _get_data_fingerprint(self, grouping):
+        """ Fingerprint of raw_df for the cache: the one it was loaded with, or
+            else a fingerprint of its columns, each hashed only the first time """
+        if self._shares_raw_data():
+            return self._itss_data._get_cache_fingerprint(grouping)
+        frame, column_fingerprints = self._column_fingerprints
+        if frame is not self.raw_df:
+            # raw_df was replaced
+            column_fingerprints = {}
+            self._column_fingerprints = (self.raw_df, column_fingerprints)
+        return cache.get_data_fingerprint(self.raw_df, grouping,
+                                          column_fingerprints=column_fingerprints)
+
+    def mark_modified(self):
+        """ Forget the fingerprints of raw_df after changing it in place (see
+            :meth:`RawITSSData.mark_modified`) """
+        if self._shares_raw_data():
+            self._itss_data.mark_modified()
+        self._column_fingerprints = (self.raw_df, {})
+
+    def update_metrics(self, itss_data, population_csv=None, n_workers=1):
+        """ Add new rows of data, e.g. a new year, to the metrics
+
+        Only the new rows are counted. Their counts are added to the counts the
+        metrics were calculated from, and the metrics (including the All_*
+        rollups) are made again from the combined counts, so the cost is that of
+        processing the new rows rather than all of the data. The new rows must
+        not overlap the data counted so far, or they'll be counted twice.
+        raw_df no longer holds all of the data the metrics are made from
+        afterwards, so it's dropped.
+
+        Args:
+            itss_data (:class:`RawITSSData` or pd.DataFrame): The new data, which can
+                also be given in chunks or partitions (see metrics.iter_frames)
+            population_csv (str or path): Filename of population demographic csv
+                (default: the one the metrics were calculated with)
+            n_workers (int): Number of processes to count the new rows with
+
+        Examples:
+            >>> met.calculate_metrics(['AgencyName', 'Year', 'DriverRace'])
+            >>> new_data = RawITSSData()
+            >>> new_data.load_single_year(2018, '2018_ITSS_Data.txt')
+            >>> met.update_metrics(new_data)
+        """
+        if self.counts is None:
+            raise ValueError('There are no counts to add to, calculate the metrics '
+                             'with the vectorized engine first')
+        new_df = itss_data.raw_data_df if isinstance(itss_data, RawITSSData) else itss_data
+        if population_csv is not None:
+            self.population_csv = population_csv
+
+        new_counts = metrics.count_by_group(new_df, self.counts.grouping, n_workers=n_workers,
+                                            metric_names=self.counts.counted())
+        self.counts = self.counts.add(new_counts)
+        self.raw_df = None
+        self._make_metrics()
+        print('Done!')
+
+    def require_metrics(self, *metric_names):
+        """ Calculate any of the given metrics that were left out by calculate_metrics
+            (see metric_names there), adding them to the metrics
+
+        Args:
+            metric_names (str): Names of metrics, or prefixes of families of metrics
+        """
+        if self.counts is None:
+            # Every metric was calculated
+            return
+        wanted = [name for name in metric_names
+                  if isinstance(name, str) and name not in self.metrics.columns]
+        names, prefixes = self.counts.uncounted(wanted)
+        if not names and not prefixes:
+            return
+        if self.raw_df is None:
+            raise ValueError(f'{wanted} weren\'t calculated, and there\'s no raw data to '
+                             'calculate them from')
+
+        print('Calculating', wanted)
+        new_counts = metrics.count_by_group(self.raw_df, self.counts.grouping,
+                                            metric_names=names + prefixes)
+        self.counts = self.counts.extend(new_counts)
+        self._make_metrics()
+
+    def _make_metrics(self):
+        """ Make the metrics again from the counts, stored as they were """
+        sparse = any(isinstance(dtype, pd.SparseDtype) for dtype in self.metrics.dtypes)
+        self.metrics = metrics.metrics_from_counts(self.counts,
+                                                   self.grouping,
+                                                   population_csv=self.population_csv,
+                                                   grouping_sets=self.grouping_sets,
+                                                   sparse=sparse)
+        self._add_intervals()
+
+    def _add_intervals(self):
+        """ Add the confidence intervals of the rates, if they're wanted """
+        if self.intervals is not None:
+            method, confidence = self.intervals
+            self.metrics = metrics.add_confidence_intervals(self.metrics, method=method,
+                                                            confidence=confidence)
 
     def get_grouping(self):
         """ Return the grouping used to calculate the metrics"""
         return self.grouping
 
-    def get_metrics_df(self):
-        """ Return the raw metrics dataframe """
+    def get_metrics_df(self, metric_names=None):
+        """ Return the raw metrics dataframe, first calculating any of metric_names
+            that haven't been """
+        if metric_names is not None:
+            self.require_metrics(*metric_names)
         return self.metrics
 
     def get_metrics(self):
@@ -220,6 +548,7 @@ class ITSSMetrics(object):
                 >>> # Compare search rates for black and white drivers
                 >>> met.plot_scatter('Black', 'White', 'SearchRate', 'SearchCount', population_col='StopCount')
         """
+        self.require_metrics(metric, size, population_col)
         sdf = self._set_level_last('AgencyName')
         ax = scatterplot.make_scatterplot(sdf, x_index, y_index, metric, size,
                                      population_col=population_col,
@@ -245,6 +574,7 @@ class ITSSMetrics(object):
                 >>> met.plot_zhist('Black', 'White', 'SearchHitCount', 'SearchCount')
         """
         assert 'AgencyName' in self.grouping and len(self.grouping) > 1
+        self.require_metrics(event_col, total_obs_col)
         sdf = self._set_level_last('AgencyName')
         zdf = zscores.get_zscore_df(sdf, target_item, reference_item,
                                     event_col, total_obs_col)
@@ -253,29 +583,61 @@ class ITSSMetrics(object):
         zhist.plot_zhist(zdf, target_item, title=title)
         return zdf
 
+    def get_zscores(self, reference_item, pairs=None, target_items=None, level=None):
+        """ Z-scores of every target group against a reference group, for every
+            agency (or other groups) and pair of event/observation counts at once
+
+            Args:
+                reference_item: index of the reference item, e.g. 'White'
+                pairs (list of tuples): (event_col, total_obs_col) pairs, e.g.
+                    ('SearchHitCount', 'SearchCount') (default: zscores.DEFAULT_PAIRS)
+                target_items (list): items to compare to the reference (default: all)
+                level (str): grouping column the items are in (default: the first
+                    one with the reference item)
+
+            Returns:
+                A tidy frame with a row per group, target item and pair (see
+                zscores.get_zscore_table)
+
+            Examples:
+                >>> # Every race against white drivers, for every agency
+                >>> met.calculate_metrics(['AgencyName', 'DriverRace'])
+                >>> zdf = met.get_zscores('White', [('SearchCount', 'StopCount'),
+                ...                                 ('SearchHitCount', 'SearchCount')])
+        """
+        if pairs is not None:
+            self.require_metrics(*[col for pair in pairs for col in pair])
+        return zscores.get_zscore_table(self.metrics, reference_item, pairs=pairs,
+                                        level=level, targets=target_items)
+
     def plot_bars(self, target_top_row, target_column,
                   only_include_rows=None,
                   title=None,
                   savename=None,
                   savecsv=False,
-                  xax_label=None):
+                  xax_label=None,
+                  intervals=True):
         """ Make a bar plot of a certain metric.
             Requires a multi-level metrics calculation be passed in.
 
             Args:
                 target_top_row (str):
+                intervals (bool): Draw error bars for the confidence intervals of
+                    the metric, if they were calculated (see calculate_metrics)
 
             Examples:
                 >>> met.calculate_metrics(['AgencyName', 'DriverRace'])
                 >>> met.plot_bars('Chicago Police', 'SearchRate')
 
         """
+        self.require_metrics(target_column)
         barplot.make_barplot(self.metrics, target_top_row, target_column,
                              only_include=only_include_rows,
                              title=title,
                              savename=savename,
                              savecsv=savecsv,
-                             xax_label=xax_label)
+                             xax_label=xax_label,
+                             intervals=intervals)
 
     def plot_timeseries(self, target_column,
                         only_include_rows=None,
@@ -283,7 +645,8 @@ class ITSSMetrics(object):
                         title=None,
                         ylabel=None,
                         savename=None,
-                        savecsv=None):
+                        savecsv=None,
+                        intervals=True):
         """ Make a timeseries plot
 
         Args:
@@ -294,31 +657,47 @@ class ITSSMetrics(object):
             ylabel (str): Plot y-axis label
             savename (str or path): Path to save the plot
             savecsv (str or path): Path to save a csv of data used to make the plot
+            intervals (bool): Shade the confidence intervals of the metric, if they
+                were calculated (see calculate_metrics)
 
         Examples:
             >>> met.plot_timeseries('SearchRate', only_include_rows='Chicago Police', only_include_entries=['Black', 'Hispanic/Latino', 'Asian', 'White'], title='Search Rate 2012-2017')
         """
+        self.require_metrics(target_column)
         sdf = self._set_level_last('Year')
         timeseries.metrics_timeseries(sdf, target_column,
                                       only_include_rows=only_include_rows,
                                       only_include_entries=only_include_entries,
                                       title=title, ylabel=ylabel,
                                       savename=savename,
-                                      savecsv=savecsv)
+                                      savecsv=savecsv,
+                                      intervals=intervals)
 
     def load(self, filename):
         """ Load a metrics object from a pickle file
-            pickled object is (grouping, metrics_df) tuple
+            pickled object is (grouping, metrics_df, grouping_sets, counts,
+            population_csv, intervals) tuple, or (grouping, metrics_df) for older files
          """
         self.grouping = None
+        self.grouping_sets = None
         self.metrics = None
+        self.counts = None
+        self.population_csv = None
+        self.intervals = None
         with open(filename, 'rb') as f:
-            (self.grouping, self.metrics) = pickle.load(f)
+            saved = pickle.load(f)
+        (self.grouping, self.metrics) = saved[:2]
+        if len(saved) > 2:
+            (self.grouping_sets, self.counts, self.population_csv) = saved[2:5]
+        if len(saved) > 5:
+            self.intervals = saved[5]
 
     def save(self, filename):
-        """ Pickle a metrics object as a (grouping, metrics_df) tuple """
+        """ Pickle a metrics object as a (grouping, metrics_df, grouping_sets, counts,
+            population_csv, intervals) tuple """
         with open(filename, 'wb') as f:
-            pickle.dump((self.grouping, self.metrics), f)
+            pickle.dump((self.grouping, self.metrics, self.grouping_sets, self.counts,
+                         self.population_csv, self.intervals), f)
 
     def save_csv(self, filename):
         """ Save the current metrics as a csv file """
@@ -0,0 +1,200 @@
+"""
+Content-addressed cache of preprocessed ITSS data.
+
+Cache entries are keyed on a fingerprint of the raw file and of the processing
+pipeline, so that replacing a raw file or changing the decoding/consolidation
+code automatically invalidates (and evicts) old entries.
+"""
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from functools import lru_cache
+import hashlib
+import os
+import pathlib
+import re
+import tempfile
+import time
+
+from .sources import split_source, source_stem, cache_stem
+
+# Bump this when processing changes in a way the module sources can't show
+# (e.g. a behavior change in pandas that we rely on)
+PIPELINE_VERSION = 1
+
+# Modules whose source defines what "processed" data looks like
+PIPELINE_MODULES = ['consolidator.py', 'date_processor.py', 'decoder.py', 'load_raw.py',
+                    'pipeline.py', 'schema.py']
+
+# Amount of the raw file (from each end) that goes into its content hash
+SAMPLE_BYTES = 1 << 20
+
+CACHE_DIR = 'preprocessed'
+CACHE_SUFFIX = 'preprocessed.feather'
+
+# Files being written are named <file>.<random>.tmp until they're complete, and
+# ones older than this are left over from writes that never finished
+TMP_SUFFIX = '.tmp'
+STALE_TMP_SECONDS = 24 * 60 * 60
+
+
+def get_file_fingerprint(filename):
+    """Fingerprint a raw file by its size, modification time and a hash of its
+       first and last megabyte (plus the member name for a file in an archive)"""
+    filepath, member = split_source(filename)
+    stat = filepath.stat()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    if member is not None:
+        digest.update(member.encode())
+    with open(filepath, 'rb') as f:
+        digest.update(f.read(SAMPLE_BYTES))
+        if stat.st_size > SAMPLE_BYTES:
+            f.seek(max(SAMPLE_BYTES, stat.st_size - SAMPLE_BYTES))
+            digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def get_source_fingerprint(module_dir, modules, version):
+    """Fingerprint code by a version and the source of the given modules"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(version).encode())
+    for module in modules:
+        digest.update((pathlib.Path(module_dir) / module).read_bytes())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_pipeline_fingerprint():
+    """Fingerprint the processing pipeline by its version and source code"""
+    return get_source_fingerprint(pathlib.Path(__file__).parent, PIPELINE_MODULES,
+                                  PIPELINE_VERSION)
+
+
+def get_load_fingerprint(year_filename_list, columns=None):
+    """Fingerprint the processed data loaded from (year, filename) pairs by the
+       raw files and the pipeline, without looking at the data itself"""
+    digest = hashlib.blake2b(digest_size=16)
+    for year, filename in year_filename_list:
+        digest.update(f'{year}:{get_file_fingerprint(filename)}'.encode())
+    digest.update(repr(columns and list(columns)).encode())
+    digest.update(get_pipeline_fingerprint().encode())
+    return digest.hexdigest()
+
+
+def get_cache_key(filename):
+    """Key for the cache entry of a raw file under the current pipeline"""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(get_file_fingerprint(filename).encode())
+    digest.update(get_pipeline_fingerprint().encode())
+    return digest.hexdigest()
+
+
+def get_preprocessed_filename(filename):
+    """Get the name for the preprocessed directory and file"""
+    filepath, _ = split_source(filename)
+    base_name = cache_stem(filename)
+    new_file_name = '_'.join([base_name, get_cache_key(filename), CACHE_SUFFIX])
+    new_dir = pathlib.Path(os.path.dirname(filepath)) / CACHE_DIR
+    new_dir.mkdir(exist_ok=True)
+    new_file_path = new_dir / new_file_name
+    return new_file_path
+
+
+def evict_stale(filename):
+    """Remove every cache entry for a raw file other than the current one,
+       including those older versions named by the file's stem alone (e.g. the
+       pickles)"""
+    current = get_preprocessed_filename(filename)
+    entry_name = rf'_[0-9a-f]{{16}}_{re.escape(CACHE_SUFFIX)}'
+    pattern = re.compile(rf'^({re.escape(cache_stem(filename))}{entry_name}'
+                         rf'|{re.escape(source_stem(filename))}({entry_name}|_preprocessed\.(pkl|feather)))$')
+    for entry in current.parent.iterdir():
+        if entry != current and pattern.match(entry.name):
+            print(f'Evicting stale preprocessed data {entry}')
+            entry.unlink()
+    remove_stale_tmp(current.parent)
+
+
+def remove_stale_tmp(directory, max_age=STALE_TMP_SECONDS):
+    """Remove the temporary files of writes that never finished (e.g. after a
+       crash), leaving those young enough to still be being written"""
+    cutoff = time.time() - max_age
+    for entry in pathlib.Path(directory).glob('*' + TMP_SUFFIX):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                print(f'Removing unfinished write {entry}')
+                entry.unlink()
+        except FileNotFoundError:
+            # Removed by another process meanwhile
+            pass
+
+
+def _is_mixed(values):
+    return pd.api.types.infer_dtype(values, skipna=True).startswith('mixed')
+
+
+def _arrow_compatible(df):
+    """Arrow needs a single type per column, so render mixed-type columns
+       (e.g. unknown codes left next to decoded strings) as strings"""
+    mixed = [col for col in df.columns
+             if (df[col].dtype == object and _is_mixed(df[col]))
+             or (pd.api.types.is_categorical_dtype(df[col])
+                 and _is_mixed(df[col].cat.categories))]
+    if not mixed:
+        return df
+    df = df.copy(deep=False)
+    for col in mixed:
+        if pd.api.types.is_categorical_dtype(df[col]):
+            df[col] = df[col].cat.rename_categories(df[col].cat.categories.astype(str))
+        else:
+            df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+    return df
+
+
+def write_atomically(filename, write):
+    """Write a file with write(tmp_filename), moving it into place only once
+       it is complete, so readers never see a partly written file
+
+       Every write has a temporary file of its own next to filename, so
+       concurrent writers don't clash, and it's removed if the write fails."""
+    filename = pathlib.Path(filename)
+    with tempfile.NamedTemporaryFile(dir=filename.parent, prefix=filename.name + '.',
+                                     suffix=TMP_SUFFIX, delete=False) as tmp:
+        tmp_filename = tmp.name
+    try:
+        # Temporary files are private, give it the permissions of a new file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_filename, 0o666 & ~umask)
+        write(tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+def save_preprocessed(df, filename):
+    """Write processed data to the columnar (Feather) cache
+
+       The file is left uncompressed so that it can be memory-mapped, and is
+       moved into place only once it is complete."""
+    table = pa.Table.from_pandas(_arrow_compatible(df), preserve_index=False)
+    write_atomically(filename, lambda tmp_filename: feather.write_feather(
+        table, tmp_filename, compression='uncompressed'))
+    print(f'Processed data saved to {filename}.')
+
+
+def preprocessed_columns(filename):
+    """Names of the columns in a processed data file, read from its schema"""
+    with pa.memory_map(str(filename)) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def read_preprocessed(filename, columns=None):
+    """Memory-map processed data from the columnar cache, optionally
+       reading only the given columns"""
+    table = feather.read_table(str(filename), columns=columns, memory_map=True)
+    # One block per column, so columns can be released independently
+    return table.to_pandas(split_blocks=True, self_destruct=True)
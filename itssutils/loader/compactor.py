@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+# Low-cardinality string columns that should always be categorical
+CATEGORY_COLUMNS = ['AgencyName',
+                    'DriverRace',
+                    'DriverSex',
+                    'ReasonForStop',
+                    'ResultOfStop',
+                    'TypeOfMovingViolation',
+                    'VehicleSearchConductedBy',
+                    'DriverSearchConductedBy',
+                    'PassengerSearchConductedBy',
+                    'VehicleDrugAmount',
+                    'DriverPassengerDrugAmount',
+                    'PoliceDogDrugAmount']
+
+# Any other string column with fewer distinct values than this fraction of
+# its length is stored as a categorical
+CATEGORY_RATIO = 0.5
+
+# Smallest integer types first
+INT_TYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def _smallest_int(values):
+    """Name of the smallest integer dtype that holds all the (non-null) values"""
+    if not len(values):
+        return 'int8'
+    low, high = values.min(), values.max()
+    for int_type in INT_TYPES:
+        info = np.iinfo(int_type)
+        if info.min <= low and high <= info.max:
+            return np.dtype(int_type).name
+    return None
+
+
+def compact_column(values):
+    """Return values in the most compact dtype that represents them exactly
+
+    - low-cardinality strings become categoricals
+    - True/False columns with missing values become nullable booleans
+    - whole-number floats (i.e. integer codes with missing values) become the
+      smallest nullable integer type, e.g. Int8 for the 0/1/2 flag columns
+    - integers are downcast to the smallest integer type
+    """
+    dtype = values.dtype
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_extension_array_dtype(dtype):
+        return values
+
+    if dtype == object:
+        inferred = pd.api.types.infer_dtype(values, skipna=True)
+        if inferred == 'boolean':
+            return values.astype('boolean')
+        if values.name in CATEGORY_COLUMNS or values.nunique() < CATEGORY_RATIO * len(values):
+            return values.astype('category')
+        return values
+
+    if pd.api.types.is_integer_dtype(dtype):
+        smallest = _smallest_int(values.values)
+        return values.astype(smallest) if smallest else values
+
+    if pd.api.types.is_float_dtype(dtype):
+        present = values.dropna().values
+        if np.array_equal(present, np.floor(present)):
+            smallest = _smallest_int(present)
+            if smallest:
+                nullable = smallest.capitalize()
+                return values.astype(nullable if values.hasnans else smallest)
+
+    return values
+
+
+def compact_dtypes(df):
+    """Shrink each column of df to its most compact dtype, in place"""
+    for col in df.columns:
+        df[col] = compact_column(df[col])
+    return df
+
+
+def memory_report(before, after):
+    """Per-column bytes before and after compaction, largest savings first
+
+    Args:
+        before (pd.Series): ``memory_usage(deep=True)`` before compaction
+        after (pd.Series): ``memory_usage(deep=True)`` after compaction
+    """
+    report = pd.DataFrame({'before': before, 'after': after})
+    report['saved'] = report['before'] - report['after']
+    report = report.sort_values('saved', ascending=False)
+    report.loc['Total'] = report.sum()
+    return report
@@ -1,3 +1,6 @@
+import numpy as np
+import pandas as pd
+
 CONSENT_SUBJECTS = ['', 'Vehicle', 'Driver', 'Passenger']
 SEARCH_REQUEST = ['{}ConsentSearchRequested'.format(subject)
                   for subject in CONSENT_SUBJECTS]
@@ -59,7 +62,7 @@ CONSENT_OUTCOMES = ['Consent' + x for x in OUTCOME_TYPES]
 
 ALL_OUTCOMES = OUTCOME_TYPES + CONSENT_OUTCOMES + VEHICLE_OUTCOMES + DRIVER_PASSENGER_OUTCOMES + DOG_OUTCOMES
 
-# Replace column names in old data files with newer versions
+# Replace column names in old data files with newer versions (see schema.py)
 REPLACEMENTS = {'Race': 'DriverRace',
                 'MovingViolationType': 'TypeOfMovingViolation',
                 'ZIPCode': 'ZIP',
@@ -72,36 +75,63 @@ REPLACEMENTS = {'Race': 'DriverRace',
 assert ALL_OUTCOMES == ALL_OUTCOMES2
 
 
-def any_true(df, cols):
-    return (df[cols] == 1).any(axis=1)
+def title_case(values):
+    """Title-case a column of names, working on the categories of a categorical"""
+    if not pd.api.types.is_categorical_dtype(values):
+        return values.str.title()
+    codes, uniques = pd.factorize(values.cat.categories.str.title())
+    return pd.Categorical.from_codes(np.append(codes, -1).take(values.cat.codes),
+                                     uniques)
 
 
-def merge_cols(df, new_name, cols):
-    cols = [col for col in cols if col in df.columns]
-    df[new_name] = any_true(df, cols)
-    return df
+# New column -> the columns it consolidates
+CONSOLIDATIONS = [('SearchRequested', SEARCH_REQUEST),
+                  ('ConsentGiven', CONSENT_GIVEN),
+                  ('SearchConducted', SEARCH_CONDUCTED),
+                  ('DogOutcomes', DOG_OUTCOMES),
+                  ('IllegalFound', ALL_OUTCOMES),
+                  ('DogInvolved', DOG_CONSENT_GROUP),
+                  ]
+
+
+def is_value(values, value):
+    """Boolean array of where values == value, with missing values False
+
+       Categoricals are compared on their integer codes, so there's no
+       comparison against every row's value."""
+    if pd.api.types.is_categorical_dtype(values):
+        categories = values.cat.categories
+        matches = np.flatnonzero(np.asarray(categories == value, dtype=bool))
+        codes = values.cat.codes.to_numpy()
+        if len(matches) == 1:
+            return codes == matches[0]
+        return np.isin(codes, matches)
+    return values.eq(value).to_numpy(dtype=bool, na_value=False)
 
 
 def consolidate_columns(df):
     """
     Consolidate Driver/Passenger/Vehicle columns into a single column
     for easier parsing.
+
+    Each input column is compared against 1 once and OR'd into every new
+    column that it's a part of. The new columns are only written at the end,
+    since ConsentGiven and SearchConducted are inputs as well as outputs.
     """
-    consolidations = [('SearchRequested', SEARCH_REQUEST),
-                      ('ConsentGiven', CONSENT_GIVEN),
-                      ('SearchConducted', SEARCH_CONDUCTED),
-                      ('DogOutcomes', DOG_OUTCOMES),
-                      ('IllegalFound', ALL_OUTCOMES),
-                      ('DogInvolved', DOG_CONSENT_GROUP),
-                      ]
-
-    for to_replace, replace_with in REPLACEMENTS.items():
-        if to_replace in df.columns:
-            df[replace_with] = df[to_replace]
-            df = df.drop(to_replace, axis=1)
-
-    for new_col, col_group in consolidations:
-        df = merge_cols(df, new_col, col_group)
-
-    df.AgencyName = df.AgencyName.str.title()
+    merged = {new_col: np.zeros(len(df), dtype=bool) for new_col, _ in CONSOLIDATIONS}
+    groups = {}
+    for new_col, col_group in CONSOLIDATIONS:
+        for col in col_group:
+            groups.setdefault(col, []).append(merged[new_col])
+
+    for col, targets in groups.items():
+        if col in df.columns:
+            mask = is_value(df[col], 1)
+            for target in targets:
+                np.logical_or(target, mask, out=target)
+
+    for new_col, values in merged.items():
+        df[new_col] = values
+
+    df['AgencyName'] = title_case(df.AgencyName)
     return df
@@ -1,60 +1,94 @@
+import numpy as np
 import pandas as pd
-from functools import lru_cache
 
-# Caching each portion of each timestamp so that things run faster
-# (20x+, which matters when we're going to do this for every dataset + much more data)
+# Parsing works on the distinct values of a column (and the common formats go
+# straight through pandas' C parser), so there's no per-row Python and no
+# cache that grows with every new dataset.
 
+# Format of DateAndTimeOfStop: 'MM/DD/YYYY HH:MM:SS AM'
+# Note that with %H the AM/PM marker is matched but ignored, which is how these
+# times have always been read.
+DATETIME_FORMAT = '%m/%d/%Y %H:%M:%S %p'
 
-@lru_cache(maxsize=None)
-def fast_date_parse(text_datetime):
-    """ Caching function for datetime """
-    return pd.to_datetime(text_datetime)
+# Time to use when a stop has no time: one second after midnight
+DEFAULT_TIME = pd.Timedelta(seconds=1)
 
+# 'HH:MM', 'HH:MM:SS' or 'HH:MM:SS AM'
+TIME_PATTERN = r'^\s*(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::(?P<second>\d{2}))?(?:\s*(?P<ampm>[AaPp])[Mm])?\s*$'
 
-@lru_cache(maxsize=None)
-def fast_get_time(text_datetime):
-    """ Caching function for time """
-    return fast_date_parse(text_datetime).time()
+# 'MM/DD/YYYY HH:MM:SS AM', where everything after the date is optional
+DATETIME_PATTERN = r'^\s*(?P<date>\S+)(?:\s+(?P<time>\d{1,2}:\d{2}(?::\d{2})?))?'
 
 
-@lru_cache(maxsize=None)
-def fast_get_timedelta(time):
-    """ Caching function for timedelta """
-    return pd.to_timedelta(time.isoformat())
+def _map_unique(values, parser, missing):
+    """Run parser over the distinct values only and broadcast the result back
+       to every row"""
+    codes, uniques = pd.factorize(values)
+    parsed = np.asarray(parser(pd.Series(uniques, dtype=object)))
+    parsed = np.append(parsed, np.array([missing], dtype=parsed.dtype))
+    return parsed.take(codes)
 
 
-def get_date(datetimestring):
-    """ Function used to separate date_processor from date when both in same column
+def _parse_dates(uniques):
+    return pd.to_datetime(uniques, errors='coerce').values
 
-        Assume the formatting is 'MM/DD/YYYY HH:MM:SS AM'"""
-    return datetimestring.split(' ')[0]
 
+def _parse_times(uniques, use_ampm=True):
+    """Time since midnight for 'HH:MM[:SS][ AM]' strings
 
-def get_time(datetimestring):
-    """ Function used to separate time from date when both in same column
+       Some times are improperly formatted, so each hour is modded by 24."""
+    parts = uniques.astype(str).str.extract(TIME_PATTERN)
+    hour = pd.to_numeric(parts['hour'])
+    if use_ampm:
+        ampm = parts['ampm'].str.upper()
+        hour = hour.where(~((ampm == 'P') & (hour < 12)), hour + 12)
+        hour = hour.where(~((ampm == 'A') & (hour == 12)), 0)
+    seconds = ((hour % 24) * 3600
+               + pd.to_numeric(parts['minute']) * 60
+               + pd.to_numeric(parts['second']).fillna(0))
+    matched = seconds.notnull()
+    times = pd.Series(pd.NaT, index=uniques.index, dtype='timedelta64[ns]')
+    times[matched] = pd.to_timedelta(seconds[matched], unit='s')
 
-        Some times are improperly formatted. Make sure each hour is modded
-        by 24. Default to returning one second after midnight.
-        Assume the formatting is 'MM/DD/YYYY HH:MM:SS AM'"""
-    sp = datetimestring.split(' ')
-    if len(sp) > 1:
-        hms = sp[1].split(':')
-        hour = hms[0]
-        hour = int(hour) % 24
-        hour = '{:02d}'.format(hour)
-        hms = ':'.join([hour] + hms[1:])
-        return hms
-    return '00:00:01 AM'
+    # Fall back on the flexible parser for anything else
+    unmatched = ~matched & uniques.notnull()
+    if unmatched.any():
+        fallback = pd.to_datetime(uniques[unmatched], errors='coerce')
+        times[unmatched] = fallback - fallback.dt.normalize()
+    return times.values
+
+
+def _parse_datetimes(uniques):
+    """Date plus time for 'MM/DD/YYYY HH:MM:SS AM' strings that don't fit the
+       strict format, e.g. hours past 23 or a missing time"""
+    parts = uniques.astype(str).str.extract(DATETIME_PATTERN)
+    dates = _map_unique(parts['date'], _parse_dates, np.datetime64('NaT'))
+    times = _map_unique(parts['time'], lambda t: _parse_times(t, use_ampm=False),
+                        np.timedelta64('NaT'))
+    times = pd.Series(times).where(parts['time'].notnull(), DEFAULT_TIME)
+    return dates + times.values
+
+
+def parse_datetime_col(values):
+    """Parse a combined 'MM/DD/YYYY HH:MM:SS AM' column into datetime64"""
+    stop_datetime = pd.to_datetime(values, format=DATETIME_FORMAT, errors='coerce')
+    leftover = stop_datetime.isnull() & values.notnull()
+    if leftover.any():
+        stop_datetime[leftover] = _map_unique(values[leftover], _parse_datetimes,
+                                              np.datetime64('NaT'))
+    return stop_datetime
 
 
 def parse_date_cols(df):
-    """ Parse DateAndTimeOfStop into more modern, separate DateOfStop and
-        TimeOfStop """
+    """ Parse DateAndTimeOfStop (or the separate DateOfStop and TimeOfStop) into
+        DateOfStop (datetime64), TimeOfStop (timedelta64 since midnight) and
+        StopDateTime (datetime64) """
     if 'DateAndTimeOfStop' in df.columns:
-        df.loc[:, 'DateOfStop'] = df.DateAndTimeOfStop.apply(get_date)
-        df.loc[:, 'TimeOfStop'] = df.DateAndTimeOfStop.apply(get_time)
-    df.loc[:, 'DateOfStop'] = df.DateOfStop.apply(fast_date_parse)
-    df.loc[:, 'TimeOfStop'] = df.TimeOfStop.apply(fast_get_time)
-    stop_timedelta = df.TimeOfStop.apply(fast_get_timedelta)
-    df.loc[:, 'StopDateTime'] = df.DateOfStop + stop_timedelta
+        stop_datetime = parse_datetime_col(df.DateAndTimeOfStop)
+        df['DateOfStop'] = stop_datetime.dt.normalize()
+        df['TimeOfStop'] = stop_datetime - df.DateOfStop
+    else:
+        df['DateOfStop'] = _map_unique(df.DateOfStop, _parse_dates, np.datetime64('NaT'))
+        df['TimeOfStop'] = _map_unique(df.TimeOfStop, _parse_times, np.timedelta64('NaT'))
+    df['StopDateTime'] = df.DateOfStop + df.TimeOfStop
     return df
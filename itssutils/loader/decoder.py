@@ -157,18 +157,34 @@ class Decoder(object):
         # Set our decoder to use the default if the column isn't known
         self.decoder = lambda x: self.decoder_ring.get(x, self.default_code)
 
-    def decode_column(self, df, col_name):
-        """Translate the raw data into useful, human-readable values"""
-        df = df.copy()
+    def decode_values(self, values, col_name):
+        """Translate a column of raw values into a categorical of human-readable
+           values; anything the decoder doesn't know keeps its raw value
+
+           Only the distinct values are looked up, so this is cheap even for
+           millions of rows."""
         decoder = self.decoder(col_name)
-        new_values = []
-        for i, val in df[col_name].items():
+        codes, uniques = pd.factorize(values)
+        decoded = np.empty(len(uniques), dtype=object)
+        for i, val in enumerate(np.asarray(uniques, dtype=object)):
             try:
-                new_val = decoder[val]
-            except:
-                new_val = val
-            new_values.append(new_val)
-        df[col_name] = new_values
+                decoded[i] = decoder[val]
+            except (KeyError, TypeError):
+                decoded[i] = val
+        try:
+            new_codes, categories = pd.factorize(decoded, sort=True)
+        except TypeError:
+            # Can't sort a mix of decoded strings and unknown raw codes
+            new_codes, categories = pd.factorize(decoded)
+        # Missing values (code -1) and values decoded to NaN both end up as -1
+        new_codes = np.append(new_codes, -1)
+        return pd.Categorical.from_codes(new_codes.take(codes), categories)
+
+    def decode_column(self, df, col_name, inplace=False):
+        """Translate the raw data into useful, human-readable values"""
+        if not inplace:
+            df = df.copy()
+        df[col_name] = self.decode_values(df[col_name], col_name)
         return df
 
 
@@ -1,132 +1,338 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from pandas.api.types import union_categoricals
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import os
 import pathlib
+import tempfile
+
+from .cache import (get_preprocessed_filename, evict_stale,
+                    save_preprocessed, read_preprocessed)
+from .pipeline import run_stages
+from .schema import get_schema
+from .sources import open_source
+
+# Default number of rows per chunk when streaming raw data
+DEFAULT_CHUNKSIZE = 500000
+
+
+def process_data(raw_data_df, verbose=True, memory_budget=None, profile=False):
+    """Processes the raw data, in place
+
+       With profile, the memory and time each stage takes is recorded and the
+       per-stage report (see pipeline.run_stages) is returned with the frame,
+       as (df, report). With a memory_budget (in bytes) each stage is profiled,
+       and one that goes over the budget raises MemoryBudgetError."""
+    df, report = run_stages(raw_data_df, verbose=verbose, profile=profile,
+                            memory_budget=memory_budget)
+    return (df, report) if profile else df
+
+
+def _concat_reports(reports, name):
+    """Put per-stage reports together under a level named name (None if there
+       are no reports, e.g. for data loaded from the cache)"""
+    reports = {key: report for key, report in reports.items() if report is not None}
+    if not reports:
+        return None
+    return pd.concat(reports, names=[name])
+
+
+# How raw ITSS files are formatted
+READ_OPTIONS = dict(quoting=csv.QUOTE_NONE,
+                    encoding='ISO-8859-1',
+                    delimiter='~',
+                    na_values=['N/A'],
+                    error_bad_lines=True)
+
+# Strings read as missing: pandas' defaults plus 'N/A', spelled out for Arrow
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+             '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a',
+             'nan', 'null']
+
+# Engines that can parse raw files
+ENGINES = ['pandas', 'arrow']
+
+
+def _arrow_type(dtype):
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def _read_raw_arrow(f, options, chunksize=None):
+    """Parse an open raw ITSS file with Arrow's multithreaded CSV reader, returning
+       a frame (or an iterator of frames) laid out like pandas' reader would"""
+    read_options = pa_csv.ReadOptions(encoding=READ_OPTIONS['encoding'],
+                                      column_names=options['names'],
+                                      skip_rows=1,
+                                      use_threads=True)
+    parse_options = pa_csv.ParseOptions(delimiter=READ_OPTIONS['delimiter'],
+                                        quote_char=False)
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=options['usecols'],
+        column_types={col: _arrow_type(dtype) for col, dtype in options['dtype'].items()},
+        null_values=NA_VALUES,
+        strings_can_be_null=True)
+
+    if chunksize is None:
+        table = pa_csv.read_csv(f, read_options=read_options,
+                                parse_options=parse_options,
+                                convert_options=convert_options)
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def chunks():
+        reader = pa_csv.open_csv(f, read_options=read_options,
+                                 parse_options=parse_options,
+                                 convert_options=convert_options)
+        batches, rows, offset = [], 0, 0
+        for batch in reader:
+            batches.append(batch)
+            rows += batch.num_rows
+            if rows >= chunksize:
+                yield to_frame(batches, offset)
+                batches, offset, rows = [], offset + rows, 0
+        if batches:
+            yield to_frame(batches, offset)
+
+    def to_frame(batches, offset):
+        # Carry the row numbers on from the last chunk, like pandas does
+        df = pa.Table.from_batches(batches).to_pandas()
+        df.index += offset
+        return df
+    return chunks()
 
-from .consolidator import consolidate_columns
-from .decoder import Decoder, DECODE_COLUMNS
-from .date_processor import parse_date_cols
-
-
-def get_preprocessed_filename(filename):
-    """Get the name for the preprocessed directory and file"""
-    filepath = pathlib.Path(filename)
-    base_name = filepath.stem
-    new_file_name = '_'.join([base_name, 'preprocessed.pkl'])
-    new_dir = pathlib.Path(os.path.dirname(filepath)) / 'preprocessed'
-    if not os.path.exists(new_dir):
-        new_dir.mkdir()
-    new_file_path = new_dir / new_file_name
-    return new_file_path
-
-
-def process_data(raw_data_df):
-    """Processes the raw data"""
-    print('Parsing dates...')
-    df1 = parse_date_cols(raw_data_df)
-    print('Dates parsed.')
-
-    print('Consolidating columns...')
-    df2 = consolidate_columns(df1)
-    print('Columns consolidated.')
-
-    # Decode values to make them more humanly understandable
-    decoder = Decoder()
-    decode_cols = DECODE_COLUMNS
-
-    df3 = df2.copy()
-    print('Decoding columns...')
-    for col in decode_cols:
-        df3 = decoder.decode_column(df3, col)
-    print('Columns decoded. Done processing!')
 
-    return df3
+def _read_header(filename):
+    with open_source(filename) as f:
+        return pd.read_csv(f, nrows=0, **READ_OPTIONS).columns
 
 
-def load_data(year, filename, preprocess=True, save=False, fast=False):
+def _read_chunks(filename, year, chunksize, engine):
+    """Finalized chunks of a raw file, which stays open until they're all read"""
+    schema = get_schema(year)
+    options = schema.read_options(_read_header(filename))
+    with open_source(filename) as f:
+        if engine == 'arrow':
+            reader = _read_raw_arrow(f, options, chunksize=chunksize)
+        else:
+            reader = pd.read_csv(f, chunksize=chunksize, **options, **READ_OPTIONS)
+        for chunk in reader:
+            yield schema.finalize(chunk, year)
+
+
+def read_raw(filename, year, chunksize=None, engine='pandas'):
+    """Read a raw ITSS data file, optionally as an iterator of chunks
+
+       Column names and types come from the schema registered for the year,
+       so the columns come out standardized without any type inference.
+       The file can be compressed or a member of a zip archive (see sources).
+       engine='arrow' parses with PyArrow's multithreaded CSV reader
+       instead of pandas' C parser. (Arrow chunks hold at least chunksize
+       rows rather than exactly chunksize.)"""
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine}, must be one of {ENGINES}')
+    if chunksize is not None:
+        return _read_chunks(filename, year, chunksize, engine)
+    schema = get_schema(year)
+    options = schema.read_options(_read_header(filename))
+    with open_source(filename) as f:
+        if engine == 'arrow':
+            df = _read_raw_arrow(f, options)
+        else:
+            df = pd.read_csv(f, **options, **READ_OPTIONS)
+    return schema.finalize(df, year)
+
+
+def iter_data(year, filename, chunksize=DEFAULT_CHUNKSIZE, preprocess=True,
+              engine='pandas', memory_budget=None, profile=False):
+    """Stream a year of raw data as processed chunks of at most chunksize rows
+
+       Each chunk is read and (optionally) processed on its own,
+       so memory use is bounded by the chunk size rather than the file size.
+       With profile, (chunk, report) pairs are yielded, see process_data."""
+    print('Streaming raw data from ' + str(filename) + '...')
+    for i, chunk in enumerate(read_raw(filename, year, chunksize=chunksize,
+                                       engine=engine)):
+        report = None
+        if preprocess:
+            chunk, report = run_stages(chunk, verbose=False, profile=profile,
+                                       memory_budget=memory_budget)
+        print(f'Chunk {i} ({len(chunk)} rows) ready.')
+        yield (chunk, report) if profile else chunk
+
+
+def load_data(year, filename, preprocess=True, save=False, fast=False,
+              chunksize=None, columns=None, engine='pandas', memory_budget=None,
+              profile=False):
     """Loads and optionally processes and saves data for a given year from
-       the given directory"""
+       the given directory
+
+       If chunksize is given the file is read and processed in chunks of that
+       many rows, which keeps the intermediate processing memory bounded.
+       If columns is given only those columns are returned (and only those
+       are read when loading from the preprocessed cache).
+       engine is the CSV parser to use, 'pandas' or 'arrow' (see read_raw).
+       memory_budget is the number of bytes processing (of each chunk) may
+       use, see process_data.
+       With profile, (df, report) is returned, the report having a row per
+       processing stage (and chunk, for a chunked load) as in process_data,
+       or being None when nothing was processed (e.g. loading from the cache)."""
     year_data = pathlib.Path(filename)
     new_file_path = get_preprocessed_filename(filename)
 
     if fast:
         if os.path.exists(new_file_path):
             print(f'Loading previously processed data from {new_file_path}...')
-            df = pd.read_pickle(new_file_path)
+            df = read_preprocessed(new_file_path, columns=columns)
             print('Data loaded.')
-            return df
+            return (df, None) if profile else df
         else:
-            print('Whoops, no previously processed data to load!',
+            print('Whoops, no up-to-date preprocessed data to load!',
                   '\nGoing to process everything again.')
 
-    print('Reading raw data from ' + str(year_data) + '...')
-    # This is the big step, reading the csv
-    df = pd.read_csv(year_data,
-                     quoting=csv.QUOTE_NONE,
-                     encoding='ISO-8859-1',
-                     delimiter='~',
-                     na_values=['N/A'],
-                     low_memory=False,
-                     error_bad_lines=True)
-    df['Year'] = int(year)
-
-    # Make sure the columns all have the same names
-    name_change = {'Agency': 'AgencyName',
-                   'WasASearchConducted': 'SearchConducted',
-                   'DriversYearOfBirth': 'DriversYearofBirth'}
-    df.rename(index=str, columns=name_change, inplace=True)
-
-    # Ensure that DrugsFound in old data gets mapped to VehicleDrugsFound and DriverPassengerDrugsFound in newer data
-    to_copy = {'DrugsFound': ['VehicleDrugsFound', 'DriverPassengerDrugsFound'],}
-    for col, new_cols in to_copy.items():
-        if col in df.columns:
-            for new_col in new_cols:
-                df[new_col] = df[col]
-            df.drop(col, axis=1)
-
-    # Ensure these columns exist in the old data too, though we have to zero them out because we don't know the values
-    to_zero = ['VehicleDrugAmount', 'DriverPassengerDrugAmount']
-    for zero_col in to_zero:
-        if zero_col not in df.columns:
-            df[zero_col] = 0
-
-    if not preprocess:
-        print('Raw data loaded.')
-        return df
-
-    print('Raw data loaded...')
-    df3 = process_data(df)
-
-    if save:
-        df3.to_pickle(new_file_path)
-        print(f'Pickle saved to {new_file_path}. Done!')
+    report = None
+    if chunksize:
+        chunks = list(iter_data(year, year_data, chunksize=chunksize,
+                                preprocess=preprocess, engine=engine,
+                                memory_budget=memory_budget, profile=profile))
+        if profile:
+            report = _concat_reports(dict(enumerate(chunk_report for _, chunk_report in chunks)),
+                                     'chunk')
+            chunks = [chunk for chunk, _ in chunks]
+        df3 = concat_frames(chunks)
+    else:
+        print('Reading raw data from ' + str(year_data) + '...')
+        # This is the big step, reading the csv
+        df = read_raw(year_data, year, engine=engine)
+
+        if not preprocess:
+            print('Raw data loaded.')
+            df = df if columns is None else df[columns]
+            return (df, None) if profile else df
+
+        print('Raw data loaded...')
+        df3, report = run_stages(df, profile=profile, memory_budget=memory_budget)
+
+    # A cache miss with fast on rebuilds the entry so the next load is fast
+    if preprocess and (save or fast):
+        save_preprocessed(df3, new_file_path)
+        evict_stale(year_data)
 
     print('Done loading!')
 
-    return df3
+    if columns is not None:
+        df3 = df3[columns]
+    return (df3, report) if profile else df3
+
+
+def _concat_column(parts):
+    """Concatenate the pieces of one column, keeping categoricals categorical"""
+    if all(pd.api.types.is_categorical_dtype(part) for part in parts):
+        try:
+            return pd.Series(union_categoricals(parts), name=parts[0].name)
+        except TypeError:
+            # Categories of different types, e.g. numeric codes in one part and
+            # numeric and text codes in another
+            parts = [part.cat.set_categories(part.cat.categories.astype(object))
+                     for part in parts]
+            return pd.Series(union_categoricals(parts), name=parts[0].name)
+    return pd.concat(parts, ignore_index=True)
+
+
+def concat_frames(frames):
+    """Concatenate frames row-wise one column at a time
+
+       Each column is popped off the input frames as soon as it has been
+       copied into the result, so (for frames without consolidated blocks,
+       like those read from the preprocessed cache) the inputs are released
+       while the result is built instead of being held alongside a full copy.
+       The input frames are emptied."""
+    if len(frames) == 1:
+        return frames[0]
+    index = frames[0].index.append([df.index for df in frames[1:]])
+    columns = list(dict.fromkeys(col for df in frames for col in df.columns))
+    data = {}
+    for col in columns:
+        parts = [df.pop(col) if col in df.columns
+                 else pd.Series(np.nan, index=df.index, name=col)
+                 for df in frames]
+        data[col] = _concat_column(parts)
+    ret_df = pd.DataFrame(data, copy=False)
+    ret_df.index = index
+    return ret_df
+
 
+def _load_year_file(i, year, filename, tmp_dir, preprocess, fast, save, chunksize,
+                    engine, profile=False):
+    """Process pool worker that loads a year and hands it back as a Feather
+       file, which is much cheaper than pickling the frame back, along with
+       the processing report (None unless profiling)"""
+    if preprocess and (save or fast):
+        cache_file = get_preprocessed_filename(filename)
+        report = None
+        if not (fast and os.path.exists(cache_file)):
+            loaded = load_data(year, filename, preprocess=True, save=True,
+                               chunksize=chunksize, engine=engine, profile=profile)
+            if profile:
+                _, report = loaded
+        return cache_file, report
+    loaded = load_data(year, filename, preprocess=preprocess, chunksize=chunksize,
+                       engine=engine, profile=profile)
+    df, report = loaded if profile else (loaded, None)
+    tmp_file = pathlib.Path(tmp_dir) / f'{i}_{year}.feather'
+    save_preprocessed(df, tmp_file)
+    return tmp_file, report
+
+
+def load_multiple_years(year_filename_list, preprocess=True, save=True, fast=True,
+                        chunksize=None, columns=None, n_workers=1, engine='pandas',
+                        profile=False):
+    """ Load multiple years of raw data into a single dataframe for processing
+
+        With n_workers > 1 the years are read and processed concurrently in a
+        pool of that many processes.
+        With profile, (df, report) is returned, the report having the
+        processing report of each year that was processed (see load_data)
+        under a year level. """
+    reports = {}
+    if n_workers and n_workers > 1:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                futures = [pool.submit(_load_year_file, i, year, filename, tmp_dir,
+                                       preprocess, fast, save, chunksize, engine, profile)
+                           for i, (year, filename) in enumerate(year_filename_list)]
+                year_files = []
+                for (year, _), future in zip(year_filename_list, futures):
+                    year_file, reports[year] = future.result()
+                    year_files.append(year_file)
+            df_list = [read_preprocessed(year_file, columns=columns)
+                       for year_file in year_files]
+            ret_df = concat_frames(df_list)
+        print('Done!')
+        return (ret_df, _concat_reports(reports, 'year')) if profile else ret_df
 
-def load_multiple_years(year_filename_list, preprocess=True, save=True, fast=True):
-    """ Load multiple years of raw data into a single dataframe for processing """
     df_list = []
     for (year, filename) in year_filename_list:
         df = load_data(year, filename,
                        fast=fast,
-                       preprocess=preprocess)
+                       save=save,
+                       preprocess=preprocess,
+                       chunksize=chunksize,
+                       columns=columns,
+                       engine=engine,
+                       profile=profile)
+        if profile:
+            df, reports[year] = df
         df_list.append(df)
-        if save:
-            try:
-                savepath = get_preprocessed_filename(filename)
-                print("Saving to", str(savepath))
-                df.to_pickle(savepath)
-            except OSError:
-                print("Couldn't save - file too big.")
 
-    ret_df = pd.concat(df_list)
+    ret_df = concat_frames(df_list)
 
     print('Done!')
 
-    return ret_df
+    return (ret_df, _concat_reports(reports, 'year')) if profile else ret_df
 
 
 def load_demographic_data(demo_path):
@@ -140,7 +346,10 @@ def load_demographic_data(demo_path):
     hisp_cols = [f'hispanic_or_latino_{r}' for r in races]
     nonhisp_cols = [f'not_hispanic_or_latino_{r}' for r in races]
 
-    assert (ddf[hisp_cols].sum(axis=1) == ddf['hispanic']).all()
-    assert (ddf[nonhisp_cols].sum(axis=1) == ddf['non_hispanic']).all()
+    # Check the breakdowns add up, where the table has them
+    if set(hisp_cols + ['hispanic']) <= set(ddf.columns):
+        assert (ddf[hisp_cols].sum(axis=1) == ddf['hispanic']).all()
+    if set(nonhisp_cols + ['non_hispanic']) <= set(ddf.columns):
+        assert (ddf[nonhisp_cols].sum(axis=1) == ddf['non_hispanic']).all()
 
     return ddf
\ No newline at end of file
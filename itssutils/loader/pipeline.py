@@ -0,0 +1,120 @@
+"""
+Preprocessing pipeline for raw ITSS data.
+
+Processing is a list of stages. Each stage is a function that takes the frame,
+modifies it in place (replacing whole columns rather than copying the frame)
+and returns it, so stages can be added, removed or reordered freely. Running
+the stages with profiling records how much memory each one allocates, which
+shows whether processing fits within a memory budget.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS isn't reported
+    resource = None
+
+from .consolidator import consolidate_columns
+from .decoder import Decoder, DECODE_COLUMNS
+from .date_processor import parse_date_cols
+
+
+def decode_columns(df, columns=DECODE_COLUMNS):
+    """Decode values to make them more humanly understandable"""
+    decoder = Decoder()
+    for col in columns:
+        decoder.decode_column(df, col, inplace=True)
+    return df
+
+
+# (description, stage) in the order they run
+STAGES = [('Parsing dates', parse_date_cols),
+          ('Consolidating columns', consolidate_columns),
+          ('Decoding columns', decode_columns),
+          ]
+
+
+class MemoryBudgetError(MemoryError):
+    """A processing stage used more memory than the budget allows"""
+
+
+def get_peak_rss():
+    """Peak resident set size of this process in bytes (None if unknown)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def run_stages(df, stages=None, verbose=True, profile=False, memory_budget=None):
+    """Run a frame through each processing stage in turn
+
+    Args:
+        df (pd.DataFrame): Raw data, which is modified in place
+        stages (list): (description, stage) pairs, defaults to STAGES
+        verbose (bool): Whether to print progress
+        profile (bool): Whether to record the memory used by each stage
+        memory_budget (int): Bytes that processing may use at its peak; a
+            stage that goes over raises MemoryBudgetError (implies profile)
+
+    Returns:
+        The processed frame and, if profiling, a report with a row per stage:
+        seconds taken, bytes allocated (and still held) by the stage, the
+        stage's peak allocation, the estimated peak memory (the frame going
+        in plus the stage's peak allocation), the process' peak RSS so far and
+        the size of the frame coming out. Otherwise the report is None.
+    """
+    stages = STAGES if stages is None else stages
+    profile = profile or memory_budget is not None
+    log = print if verbose else lambda *args: None
+
+    report = []
+    started = profile and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        for name, stage in stages:
+            log(f'{name}...')
+            if not profile:
+                df = stage(df)
+                continue
+
+            size_before = frame_bytes(df)
+            # Restart the counts, so current and peak are this stage's alone
+            tracemalloc.clear_traces()
+            start = time.perf_counter()
+            df = stage(df)
+            seconds = time.perf_counter() - start
+            allocated, peak = tracemalloc.get_traced_memory()
+
+            stats = {'stage': name,
+                     'seconds': seconds,
+                     'allocated': allocated,
+                     'peak': peak,
+                     'estimated_peak': size_before + peak,
+                     'peak_rss': get_peak_rss(),
+                     'frame': frame_bytes(df)}
+            report.append(stats)
+            if memory_budget is not None and stats['estimated_peak'] > memory_budget:
+                raise MemoryBudgetError(f'{name} used an estimated '
+                                        f'{stats["estimated_peak"]:,} bytes, over the '
+                                        f'budget of {memory_budget:,} bytes')
+    finally:
+        if started:
+            tracemalloc.stop()
+    log('Done processing!')
+
+    if not profile:
+        return df, None
+    return df, pd.DataFrame(report).set_index('stage')
@@ -0,0 +1,154 @@
+"""
+Schema registry for raw ITSS data files.
+
+Each year of raw data can have its own layout. An :class:`ITSSSchema` describes
+how a year's columns map onto the names used by the most recent data, what type
+each column is read as, and which columns have to be derived for older years.
+The schema is applied while the file is parsed, so there's no type inference
+and no renaming or copying of columns after the fact.
+
+Every column has a fixed kind: free text (kept as strings), plain numbers, or
+codes. Codes are categoricals whose values are numbers where the raw value is
+one, so each value comes out the same whichever rows (or chunk) it's read with.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .consolidator import REPLACEMENTS
+
+# Columns renamed in older data files
+RENAMES = dict({'Agency': 'AgencyName',
+                'WasASearchConducted': 'SearchConducted',
+                'DriversYearOfBirth': 'DriversYearofBirth'},
+               **REPLACEMENTS)
+
+# Free-text columns with (nearly) one value per row, kept as strings
+STRING_COLUMNS = ['DateAndTimeOfStop', 'DateOfStop', 'TimeOfStop']
+
+# Columns holding plain numbers rather than codes
+NUMERIC_COLUMNS = ['DurationOfStop', 'VehicleYear', 'DriversYearofBirth']
+
+# Columns of names and identifiers, kept as categoricals of strings even where
+# their values look like numbers (e.g. ZIP 60601 next to a mistyped 6O601)
+TEXT_COLUMNS = ['AgencyName', 'AgencyCode', 'ZIP', 'BeatLocationOfStop', 'VehicleMake']
+
+# Text codes that stand for numeric codes
+BOOLEAN_CODES = {'True': 1, 'False': 0}
+
+# Ensure that DrugsFound in old data gets mapped to VehicleDrugsFound and
+# DriverPassengerDrugsFound in newer data
+COPIES = {'DrugsFound': ['VehicleDrugsFound', 'DriverPassengerDrugsFound']}
+
+# Ensure these columns exist in the old data too, though we have to zero them
+# out because we don't know the values
+ZERO_FILL = ['VehicleDrugAmount', 'DriverPassengerDrugAmount']
+
+
+def _code_value(value):
+    """A raw code as a number (an int where it's whole), or as the text it is
+       if it isn't a number, e.g. 'Speed' in years that spell codes out"""
+    if value in BOOLEAN_CODES:
+        return BOOLEAN_CODES[value]
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def _to_codes(values):
+    """Turn a categorical of raw code text into a categorical of codes, each
+       category converted on its own (see _code_value)"""
+    categories = [_code_value(value) for value in values.cat.categories]
+    # e.g. '1' and '01', which merge once they're numbers
+    codes, uniques = pd.factorize(np.array(categories + [None], dtype=object)[:-1])
+    return pd.Series(pd.Categorical.from_codes(np.append(codes, -1).take(values.cat.codes),
+                                               pd.Index(list(uniques))),
+                     index=values.index, name=values.name)
+
+
+def _to_numbers(values):
+    """Turn a categorical of numeric text into plain numbers"""
+    numbers = pd.to_numeric(values.cat.categories, errors='coerce').astype(float)
+    return pd.Series(np.append(numbers, np.nan).take(values.cat.codes),
+                     index=values.index, name=values.name)
+
+
+class ITSSSchema(object):
+    """Layout of one year of raw ITSS data
+
+    Attributes:
+        renames (dict): raw column name -> standard column name
+        dtypes (dict): standard column name -> dtype to read it as
+        default_dtype (str): dtype for every column not in dtypes
+        numeric (list of str): columns that hold plain numbers
+        text (list of str): columns kept as strings; every other categorical
+            column holds codes
+        copies (dict): column -> list of new columns that get a copy of it
+        zero_fill (list of str): columns to add, filled with 0, if missing
+    """
+
+    def __init__(self, renames=None, dtypes=None, default_dtype='category',
+                 numeric=None, text=None, copies=None, zero_fill=None):
+        self.renames = RENAMES if renames is None else renames
+        self.dtypes = ({col: 'object' for col in STRING_COLUMNS}
+                       if dtypes is None else dtypes)
+        self.default_dtype = default_dtype
+        self.numeric = NUMERIC_COLUMNS if numeric is None else numeric
+        self.text = TEXT_COLUMNS if text is None else text
+        self.copies = COPIES if copies is None else copies
+        self.zero_fill = ZERO_FILL if zero_fill is None else zero_fill
+
+    def read_options(self, header):
+        """Keyword arguments for ``read_csv`` given a file's raw header"""
+        names = [self.renames.get(col, col) for col in header]
+
+        # If the old and new name of a column are both present, the data
+        # under the old name wins and the other column isn't read
+        renamed = {self.renames[col] for col in header if col in self.renames}
+        names = [f'_{name}' if name in renamed and name == col else name
+                 for (col, name) in zip(header, names)]
+        usecols = [name for name in names if not name.startswith('_')
+                   or name[1:] not in renamed]
+
+        dtype = {name: self.dtypes.get(name, self.default_dtype) for name in usecols}
+        return {'header': 0, 'names': names, 'usecols': usecols, 'dtype': dtype}
+
+    def finalize(self, df, year):
+        """Add the year and any derived columns to freshly parsed data"""
+        for col in df.columns:
+            if pd.api.types.is_categorical_dtype(df[col]):
+                if col in self.numeric:
+                    df[col] = _to_numbers(df[col])
+                elif col not in self.text:
+                    df[col] = _to_codes(df[col])
+
+        df['Year'] = int(year)
+
+        for col, new_cols in self.copies.items():
+            if col in df.columns:
+                for new_col in new_cols:
+                    df[new_col] = df[col]
+
+        for zero_col in self.zero_fill:
+            if zero_col not in df.columns:
+                df[zero_col] = 0
+
+        return df
+
+
+DEFAULT_SCHEMA = ITSSSchema()
+
+# Schemas for years whose layout differs from the default
+SCHEMAS = {}
+
+
+def register_schema(year, schema):
+    """Use the given schema when reading the given year"""
+    SCHEMAS[int(year)] = schema
+
+
+def get_schema(year):
+    """Return the schema for the given year"""
+    return SCHEMAS.get(int(year), DEFAULT_SCHEMA)
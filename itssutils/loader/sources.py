@@ -0,0 +1,80 @@
+"""
+Opening raw ITSS files that are stored compressed or archived.
+
+A raw file can be given as a plain path, a compressed file (``.gz``, ``.bz2``,
+``.zst``, ``.lz4``) or a member of a zip archive, written
+``archive.zip::member``. (A zip archive holding a single file can be given
+without the member.) The data is decompressed as it's read, so there's no need
+to unpack the files first.
+"""
+
+import pathlib
+import zipfile
+
+import pyarrow as pa
+
+# Separates a zip archive from the member to read inside it
+MEMBER_SEP = '::'
+
+# Compressed file suffixes and the Arrow codec that reads them
+COMPRESSIONS = {'.gz': 'gzip',
+                '.bz2': 'bz2',
+                '.zst': 'zstd',
+                '.zstd': 'zstd',
+                '.lz4': 'lz4'}
+
+ARCHIVE_SUFFIXES = ['.zip']
+
+
+def split_source(filename):
+    """Split a raw file name into the path on disk and the archive member
+       (None if it doesn't name one)"""
+    path, sep, member = str(filename).partition(MEMBER_SEP)
+    return pathlib.Path(path), (member if sep else None)
+
+
+def _archive_member(archive, member):
+    """Name of the member to read from an open zip archive"""
+    if member is not None:
+        return member
+    names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    if len(names) != 1:
+        raise ValueError(f'{archive.filename} holds {len(names)} files, '
+                         f'pick one with {archive.filename}{MEMBER_SEP}<member>')
+    return names[0]
+
+
+def source_stem(filename):
+    """Name of the raw data without directories or compression and file
+       suffixes, e.g. '2017_ITSS_Data' for '2017_ITSS_Data.txt.gz' or
+       'archive.zip::2017_ITSS_Data.txt'"""
+    path, member = split_source(filename)
+    if member is not None:
+        path = pathlib.Path(member)
+    if path.suffix.lower() in COMPRESSIONS or path.suffix.lower() in ARCHIVE_SUFFIXES:
+        path = path.with_suffix('')
+    return path.stem
+
+
+def cache_stem(filename):
+    """Name of the raw data for its cache entries: the file name, and the member
+       for a file in an archive, e.g. '2017_ITSS_Data.txt.gz' or
+       'archive.zip-2017_ITSS_Data.txt', so that sources differing only in
+       compression or archive get entries of their own"""
+    path, member = split_source(filename)
+    if member is None:
+        return path.name
+    return '-'.join([path.name] + list(pathlib.PurePosixPath(member).parts))
+
+
+def open_source(filename):
+    """Open raw data as a binary file, decompressing it as it's read"""
+    path, member = split_source(filename)
+    suffix = path.suffix.lower()
+    if suffix in ARCHIVE_SUFFIXES or member is not None:
+        with zipfile.ZipFile(path) as archive:
+            # The archive's file stays open until the member is closed too
+            return archive.open(_archive_member(archive, member))
+    if suffix in COMPRESSIONS:
+        return pa.input_stream(str(path), compression=COMPRESSIONS[suffix])
+    return open(path, 'rb')
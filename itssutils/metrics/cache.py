@@ -0,0 +1,139 @@
+"""
+On-disk cache of calculated metrics.
+
+Cache entries are keyed on a fingerprint of the data the metrics are made from,
+the grouping, the population csv, the metrics code and the package version, so
+calculating the same metrics again returns the stored frame instead, while any
+change to the inputs or the code gives a new key. The cache is kept under a size
+limit by evicting the least recently used entries.
+
+Data loaded from raw files is fingerprinted by the files and the processing
+pipeline (see loader.cache.get_load_fingerprint), so a cache hit doesn't look at
+the data at all. Other frames have each column hashed, once per frame if the
+column fingerprints are kept between calls.
+"""
+
+from functools import lru_cache
+import hashlib
+import os
+import pathlib
+import pickle
+
+import pandas as pd
+
+from .. import __version__
+from ..loader.cache import get_source_fingerprint, write_atomically, remove_stale_tmp
+from .engine import input_columns
+
+# Modules whose source defines what the metrics are
+METRICS_MODULES = ['engine.py', 'metrics.py']
+
+CACHE_SUFFIX = '.metrics.pkl'
+
+# Default limit on the total size of a cache directory
+MAX_CACHE_BYTES = 1 << 30
+
+
+def get_column_fingerprint(values):
+    """Fingerprint a column by its name, type and a hash of every value"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{values.name}:{values.dtype}'.encode())
+    digest.update(pd.util.hash_pandas_object(values, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_data_fingerprint(df, grouping, column_fingerprints=None):
+    """Fingerprint the columns of processed data that the metrics by grouping
+       are made from
+
+       column_fingerprints is a dict of column -> fingerprint for df, which is
+       used instead of hashing those columns again and gets the fingerprints of
+       any newly hashed columns."""
+    if column_fingerprints is None:
+        column_fingerprints = {}
+    digest = hashlib.blake2b(digest_size=16)
+    columns = list(dict.fromkeys(list(grouping) + input_columns()))
+    for col in columns:
+        if col not in df.columns:
+            continue
+        if col not in column_fingerprints:
+            column_fingerprints[col] = get_column_fingerprint(df[col])
+        digest.update(column_fingerprints[col].encode())
+    return digest.hexdigest()
+
+
+def get_population_fingerprint(population_csv):
+    """Fingerprint a population csv by its contents ('' for no population)"""
+    if not population_csv:
+        return ''
+    return hashlib.blake2b(pathlib.Path(population_csv).read_bytes(),
+                           digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_code_fingerprint():
+    """Fingerprint the metrics code by the package version and source code"""
+    return get_source_fingerprint(pathlib.Path(__file__).parent, METRICS_MODULES,
+                                  __version__)
+
+
+def get_cache_key(df, grouping, grouping_sets, population_csv, engine, sparse=False,
+                  metric_names=None, intervals=None, data_fingerprint=None):
+    """Key for the cache entry of metrics calculated from df, which is only
+       hashed if its data_fingerprint isn't given"""
+    if data_fingerprint is None:
+        data_fingerprint = get_data_fingerprint(df, grouping)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(data_fingerprint.encode())
+    digest.update(repr((list(grouping), list(grouping_sets), engine, sparse,
+                        metric_names and list(metric_names), intervals)).encode())
+    digest.update(get_population_fingerprint(population_csv).encode())
+    digest.update(get_code_fingerprint().encode())
+    return digest.hexdigest()
+
+
+def get_cache_filename(cache_dir, key):
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / (key + CACHE_SUFFIX)
+
+
+def read_cached(cache_dir, key):
+    """The entry stored under key, or None if there isn't one"""
+    filename = get_cache_filename(cache_dir, key)
+    try:
+        with open(filename, 'rb') as f:
+            entry = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    # Mark the entry as recently used
+    os.utime(filename)
+    print(f'Loaded cached metrics from {filename}.')
+    return entry
+
+
+def evict_least_recent(cache_dir, max_bytes=MAX_CACHE_BYTES):
+    """Remove the least recently used entries until the cache fits in max_bytes,
+       and any files left by writes that never finished"""
+    remove_stale_tmp(cache_dir)
+    entries = sorted(pathlib.Path(cache_dir).glob('*' + CACHE_SUFFIX),
+                     key=lambda entry: entry.stat().st_mtime_ns)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        print(f'Evicting cached metrics {entry}')
+        total -= entry.stat().st_size
+        entry.unlink()
+
+
+def save_cached(cache_dir, key, entry, max_bytes=MAX_CACHE_BYTES):
+    """Store an entry under key, then evict entries to keep within max_bytes
+
+       The file is moved into place only once it is complete."""
+    def write(tmp_filename):
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(entry, f)
+
+    write_atomically(get_cache_filename(cache_dir, key), write)
+    evict_least_recent(cache_dir, max_bytes=max_bytes)
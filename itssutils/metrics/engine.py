@@ -0,0 +1,738 @@
+"""
+Vectorized engine for calculating metrics by group.
+
+Rather than filtering a sub-frame for every group and counting within it (see
+calc_metrics), every row gets an integer code for its group and each count is a
+``np.bincount`` of the codes of the rows it covers, so each count is taken for
+all of the groups at once. Rates are then column arithmetic on the resulting
+table of counts, following the definitions below.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from ..loader.consolidator import is_value
+
+# Boolean columns made by the consolidator
+FLAG_COLUMNS = ['SearchConducted',
+                'SearchRequested',
+                'ConsentGiven',
+                'IllegalFound',
+                'DogInvolved']
+
+# Indicators for a column having a given value: name -> (column, value)
+VALUE_INDICATORS = {'MovingViolation': ('ReasonForStop', 'MovingViolation'),
+                    'Citation': ('ResultOfStop', 'Citation')}
+
+# Indicators for the raw police dog codes: name -> column (1 means yes)
+DOG_INDICATORS = {'DogSniff': 'PoliceDogPerformSniffOfVehicle',
+                  'DogAlert': 'PoliceDogAlertIfSniffed',
+                  'DogSearch': 'PoliceDogVehicleSearched',
+                  'DogHit': 'PoliceDogContrabandFound'}
+
+# Counts of the rows that have every one of the indicators ('~' for rows that
+# don't). Counts starting with _ are only used to derive other metrics.
+COUNTS = [('StopCount', []),
+          ('SearchCount', ['SearchConducted']),
+          ('SearchRequestCount', ['SearchRequested']),
+          ('ConsentGivenCount', ['SearchRequested', 'ConsentGiven']),
+          ('SearchWithConsentCount', ['SearchRequested', 'SearchConducted', 'ConsentGiven']),
+          ('SearchWithConsentContrabandCount', ['SearchRequested', 'SearchConducted',
+                                                'ConsentGiven', 'IllegalFound']),
+          ('SearchWithoutConsentCount', ['SearchRequested', 'SearchConducted', '~ConsentGiven']),
+          ('SearchWithoutConsentContrabandCount', ['SearchRequested', 'SearchConducted',
+                                                   '~ConsentGiven', 'IllegalFound']),
+          ('OtherSearchCount', ['SearchConducted', '~SearchRequested']),
+          ('OtherSearchContrabandCount', ['SearchConducted', '~SearchRequested', 'IllegalFound']),
+          ('DogInvolvedCount', ['DogInvolved']),
+          ('SearchHitCount', ['SearchConducted', 'IllegalFound']),
+          ('StopHitCount', ['IllegalFound']),
+          ('DogSniffCount', ['DogInvolved', 'DogSniff']),
+          ('DogAlertCount', ['DogInvolved', 'DogAlert']),
+          ('DogSearchCount', ['DogInvolved', 'DogSearch']),
+          ('DogFoundContrabandCount', ['DogInvolved', 'DogHit']),
+          ('_SearchConsentCount', ['SearchConducted', 'ConsentGiven']),
+          ('_MovingViolationCount', ['MovingViolation']),
+          ]
+
+# Metrics as (name, numerator, denominator, conditions). A metric is the
+# numerator divided by the denominator (just the numerator without one), and
+# is only given for groups where every count in conditions is nonzero (the
+# plain counts have no conditions, so they're given even with no stops).
+METRICS = [('StopCount', 'StopCount', None, []),
+           ('SearchCount', 'SearchCount', None, []),
+           ('SearchRequestCount', 'SearchRequestCount', None, []),
+           ('ConsentGivenCount', 'ConsentGivenCount', None, []),
+           ('SearchWithConsentCount', 'SearchWithConsentCount', None, []),
+           ('SearchWithConsentContrabandCount', 'SearchWithConsentContrabandCount', None, []),
+           ('SearchWithoutConsentCount', 'SearchWithoutConsentCount', None, []),
+           ('SearchWithoutConsentContrabandCount', 'SearchWithoutConsentContrabandCount', None, []),
+           ('OtherSearchCount', 'OtherSearchCount', None, []),
+           ('OtherSearchContrabandCount', 'OtherSearchContrabandCount', None, []),
+           ('DogInvolvedCount', 'DogInvolvedCount', None, []),
+           ('SearchHitCount', 'SearchHitCount', None, []),
+           ('StopHitCount', 'StopHitCount', None, []),
+           ('StopHitRate', 'StopHitCount', 'StopCount', ['StopCount']),
+           ('SearchRate', 'SearchCount', 'StopCount', ['StopCount']),
+           ('SearchRequestRate', 'SearchRequestCount', 'StopCount', ['StopCount']),
+           ('SearchWithConsentStopsRate', 'SearchWithConsentCount', 'StopCount', ['StopCount']),
+           ('OtherSearchRate', 'OtherSearchCount', 'StopCount', ['StopCount']),
+           ('DogInvolvedRate', 'DogInvolvedCount', 'StopCount', ['StopCount']),
+           ('SearchWithConsentContrabandRate', 'SearchWithConsentContrabandCount',
+            'SearchWithConsentCount', ['SearchWithConsentCount']),
+           ('SearchWithoutConsentContrabandRate', 'SearchWithoutConsentContrabandCount',
+            'SearchWithoutConsentCount', ['SearchWithoutConsentCount']),
+           ('OtherSearchContrabandRate', 'OtherSearchContrabandCount',
+            'OtherSearchCount', ['OtherSearchCount']),
+           ('Population', 'Population', None, ['StopCount', '_HasPopulation']),
+           ('StopsPerPop', 'StopCount', 'Population', ['StopCount', '_HasPopulation']),
+           ('SearchHitRate', 'SearchHitCount', 'SearchCount', ['SearchCount']),
+           ('SearchesPerPop', 'SearchCount', 'Population', ['SearchCount', '_HasPopulation']),
+           ('ConsentGivenRate', '_SearchConsentCount', 'SearchRequestCount', ['SearchRequestCount']),
+           ('SearchWithConsentRate', 'SearchWithConsentCount', 'SearchRequestCount', ['SearchRequestCount']),
+           ('SearchWithoutConsentRate', 'SearchWithoutConsentCount', 'SearchRequestCount',
+            ['SearchRequestCount']),
+           ('SearchRequestPerPop', 'SearchRequestCount', 'Population',
+            ['SearchRequestCount', '_HasPopulation']),
+           ('DogSniffCount', 'DogSniffCount', None, ['DogInvolvedCount']),
+           ('DogSniffRate', 'DogSniffCount', 'StopCount', ['DogInvolvedCount']),
+           ('DogAlertCount', 'DogAlertCount', None, ['DogInvolvedCount']),
+           ('DogAlertRate', 'DogAlertCount', 'DogSniffCount', ['DogSniffCount']),
+           ('DogSearchCount', 'DogSearchCount', None, ['DogInvolvedCount']),
+           ('DogSearchRate', 'DogSearchCount', 'DogSniffCount', ['DogSniffCount']),
+           ('DogSearchStopsRate', 'DogSearchCount', 'StopCount', ['DogSniffCount']),
+           ('DogFoundContrabandCount', 'DogFoundContrabandCount', None, ['DogInvolvedCount']),
+           ('DogFoundContrabandRate', 'DogFoundContrabandCount', 'DogSearchCount', ['DogSearchCount']),
+           ]
+
+# Families of counts and metrics with one member for each value of a column,
+# as (prefix, column, shorten, counts, metrics). In names {} stands for the
+# prefix and the value (or with shorten, just the first word of the value).
+FAMILIES = [('Reason-', 'ReasonForStop', False,
+             [('{}Count', []),
+              ('{}CitationCount', ['Citation']),
+              ('{}SearchCount', ['SearchConducted']),
+              ('{}HitCount', ['IllegalFound'])],
+             [('{}Count', '{}Count', None, ['{}Count']),
+              ('{}Rate', '{}Count', 'StopCount', ['{}Count']),
+              ('{}CitationCount', '{}CitationCount', None, ['{}Count']),
+              ('{}CitationRate', '{}CitationCount', '{}Count', ['{}Count']),
+              ('{}SearchCount', '{}SearchCount', None, ['{}Count']),
+              ('{}SearchRate', '{}SearchCount', '{}Count', ['{}Count']),
+              ('{}HitCount', '{}HitCount', None, ['{}SearchCount']),
+              ('{}HitRate', '{}HitCount', '{}SearchCount', ['{}SearchCount'])]),
+            ('Result-', 'ResultOfStop', True,
+             [('{}Count', [])],
+             [('{}Count', '{}Count', None, ['{}Count']),
+              ('{}Rate', '{}Count', 'StopCount', ['{}Count'])]),
+            ('move-', 'TypeOfMovingViolation', True,
+             [('{}Count', ['MovingViolation']),
+              ('{}CitationCount', ['MovingViolation', 'Citation']),
+              ('{}SearchCount', ['MovingViolation', 'SearchConducted']),
+              ('{}HitCount', ['MovingViolation', 'IllegalFound'])],
+             [('{}Count', '{}Count', None, ['{}Count']),
+              ('{}Rate', '{}Count', '_MovingViolationCount', ['{}Count']),
+              ('{}StopsRate', '{}Count', 'StopCount', ['{}Count']),
+              ('{}CitationCount', '{}CitationCount', None, ['{}Count']),
+              ('{}CitationRate', '{}CitationCount', '{}Count', ['{}Count']),
+              ('{}CitationStopsRate', '{}CitationCount', 'StopCount', ['{}Count']),
+              ('{}SearchCount', '{}SearchCount', None, ['{}Count']),
+              ('{}SearchRate', '{}SearchCount', '{}Count', ['{}Count']),
+              ('{}SearchStopsRate', '{}SearchCount', 'StopCount', ['{}Count']),
+              ('{}HitCount', '{}HitCount', None, ['{}SearchCount']),
+              ('{}HitRate', '{}HitCount', '{}SearchCount', ['{}SearchCount'])]),
+            ]
+
+# Suffixes of the confidence bounds of a rate, e.g. SearchRateLower
+BOUND_SUFFIXES = ('Lower', 'Upper')
+
+
+def get_indicators(df, names=None):
+    """Indicator name -> boolean array over the rows of df, for the given
+       indicators (default: all of them)"""
+    indicators = {}
+    for col in FLAG_COLUMNS:
+        if names is None or col in names:
+            indicators[col] = df[col].to_numpy(dtype=bool, na_value=False)
+    for name, (col, value) in VALUE_INDICATORS.items():
+        if names is None or name in names:
+            indicators[name] = is_value(df[col], value)
+    for name, col in DOG_INDICATORS.items():
+        if names is None or name in names:
+            # Data without the dog columns has no dog sniffs (like calc_metrics)
+            indicators[name] = (is_value(df[col], 1) if col in df.columns
+                                else np.zeros(len(df), dtype=bool))
+    return indicators
+
+
+def _metric_inputs(definition):
+    """Names of the counts (or Population) a metric definition is made from"""
+    _, numerator, denominator, conditions = definition
+    return [numerator] + ([denominator] if denominator else []) + list(conditions)
+
+
+def select_counts(metric_names=None, errors='raise'):
+    """The counts and families needed to calculate the given metrics
+
+    Args:
+        metric_names (list of str): Metric names, or family prefixes (e.g.
+            'Reason-') for every metric of a family; defaults to all metrics
+        errors (str): 'raise' to raise a ValueError for names that aren't
+            metrics, or 'ignore' to skip them
+
+    Returns:
+        Names of the counts in COUNTS and prefixes of the families to count
+    """
+    if metric_names is None:
+        return [name for name, _ in COUNTS], [prefix for prefix, _, _, _, _ in FAMILIES]
+    if isinstance(metric_names, str):
+        metric_names = [metric_names]
+
+    definitions = {definition[0]: definition for definition in METRICS}
+    count_names = {name for name, _ in COUNTS}
+    needed = set()
+    prefixes = set()
+    for name in metric_names:
+        if name.endswith(BOUND_SUFFIXES):
+            # The bounds of a rate come from the rate's counts
+            name = name[:-len('Lower')]
+        family = [family for family in FAMILIES if name.startswith(family[0])]
+        if family:
+            prefix, _, _, _, metrics = family[0]
+            prefixes.add(prefix)
+            # The counts outside the family that its metrics use
+            for definition in metrics:
+                needed.update(input_name for input_name in _metric_inputs(definition)
+                              if '{}' not in input_name)
+        elif name in definitions:
+            needed.update(_metric_inputs(definitions[name]))
+        elif name in count_names:
+            needed.add(name)
+        elif errors == 'raise':
+            raise ValueError(f'Unknown metric {name}')
+    return ([name for name, _ in COUNTS if name in needed],
+            [prefix for prefix, _, _, _, _ in FAMILIES if prefix in prefixes])
+
+
+def _select_rows(indicators, terms):
+    """Positions of the rows with all of the terms (None for every row)"""
+    if not terms:
+        return None
+    mask = np.ones(len(next(iter(indicators.values()))), dtype=bool)
+    for term in terms:
+        if term.startswith('~'):
+            mask &= ~indicators[term[1:]]
+        else:
+            mask &= indicators[term]
+    return np.flatnonzero(mask)
+
+
+def short_name(value):
+    """First word of a value, e.g. 'Written' for 'Written Warning'"""
+    words = str(value).split()
+    return words[0] if words else str(value)
+
+
+def _value_codes(values, shorten):
+    """Integer codes (-1 for missing) and labels for the values of a column"""
+    if pd.api.types.is_categorical_dtype(values):
+        codes, labels = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, labels = pd.factorize(values)
+    labels = [short_name(label) if shorten else f'{label}' for label in labels]
+    # Values that share a (short) name are counted together
+    label_codes, labels = pd.factorize(np.asarray(labels, dtype=object))
+    codes = np.where(codes >= 0, np.append(label_codes, -1).take(codes), -1)
+    return codes, list(labels)
+
+
+def _default_selection(counts, families):
+    """Counts and families to take, with None for all of them"""
+    default_counts, default_families = select_counts()
+    return (default_counts if counts is None else counts,
+            default_families if families is None else families)
+
+
+def _indicator_names(counts, families):
+    """Names of the indicators the given counts and families use"""
+    count_terms = dict(COUNTS)
+    terms = [term for name in counts for term in count_terms[name]]
+    terms += [term for prefix, _, _, family_counts, _ in FAMILIES if prefix in families
+              for _, family_terms in family_counts for term in family_terms]
+    return {term.lstrip('~') for term in terms}
+
+
+def input_columns(counts=None, families=None):
+    """Columns of stop data that the given counts and families (see
+       select_counts; default: all of them) are made from"""
+    counts, families = _default_selection(counts, families)
+    indicator_columns = dict({col: col for col in FLAG_COLUMNS},
+                             **{name: col for name, (col, _) in VALUE_INDICATORS.items()},
+                             **DOG_INDICATORS)
+    names = _indicator_names(counts, families)
+    columns = [col for name, col in indicator_columns.items() if name in names]
+    columns += [col for prefix, col, _, _, _ in FAMILIES if prefix in families]
+    return list(dict.fromkeys(columns))
+
+
+class CountPlan(object):
+    """The rows that go into each count, worked out once for a frame and then
+    used to count any grouping of it
+
+    Attributes:
+        n_rows (int): Number of rows in the frame
+        rows (dict): count name -> positions of its rows (None for all rows)
+        families (list): (prefix, labels, [(count name, rows, value codes)])
+            for each family, with values ordered by how common they are
+    """
+
+    def __init__(self, df, counts=None, families=None):
+        """Plan the given counts and families (see select_counts), by default
+           all of them; only the columns they need are read"""
+        counts, families = _default_selection(counts, families)
+        count_terms = dict(COUNTS)
+        selected = [family for family in FAMILIES if family[0] in families]
+
+        indicators = get_indicators(df, _indicator_names(counts, families))
+        self.n_rows = len(df)
+        self.rows = {name: _select_rows(indicators, count_terms[name]) for name in counts}
+
+        self.families = []
+        for prefix, col, shorten, counts, _ in selected:
+            codes, labels = _value_codes(df[col], shorten)
+            family_counts = []
+            for name, terms in counts:
+                rows = _select_rows(indicators, terms)
+                value_codes = codes if rows is None else codes[rows]
+                keep = value_codes >= 0
+                rows = np.flatnonzero(keep) if rows is None else rows[keep]
+                family_counts.append((name, rows, value_codes[keep]))
+
+            # Only values that occur, most common first (like value_counts)
+            totals = np.bincount(family_counts[0][2], minlength=len(labels))
+            order = [i for i in np.argsort(-totals, kind='stable') if totals[i]]
+            remap = np.full(len(labels), -1)
+            remap[order] = np.arange(len(order))
+            family_counts = [(name, rows, remap[value_codes])
+                             for name, rows, value_codes in family_counts]
+            self.families.append((prefix, [labels[i] for i in order], family_counts))
+
+    def count(self, group_ids, n_groups):
+        """Table of counts (name -> array with one count per group) for rows
+           labeled with group codes 0 to n_groups - 1 (-1 to leave a row out)"""
+        has_missing = (group_ids < 0).any()
+
+        def bincount(ids, minlength):
+            if has_missing:
+                ids = ids[ids >= 0]
+            return np.bincount(ids, minlength=minlength)
+
+        counts = {}
+        for name, rows in self.rows.items():
+            counts[name] = bincount(group_ids if rows is None else group_ids[rows], n_groups)
+
+        for prefix, labels, family_counts in self.families:
+            n_values = len(labels)
+            for name, rows, value_codes in family_counts:
+                ids = group_ids[rows]
+                combined = np.where(ids >= 0, ids * n_values + value_codes, -1)
+                table = bincount(combined, n_groups * n_values).reshape(n_groups, n_values)
+                for i, label in enumerate(labels):
+                    counts[name.format(prefix + label)] = table[:, i]
+        return counts
+
+    def metric_definitions(self):
+        """Every metric definition, with the families expanded for the values
+           in the frame"""
+        return metric_definitions([(prefix, labels) for prefix, labels, _ in self.families])
+
+
+def metric_definitions(families):
+    """Every metric definition, with the families expanded for the given
+       (prefix, labels) of each family"""
+    templates = {prefix: metrics for prefix, _, _, _, metrics in FAMILIES}
+    definitions = list(METRICS)
+    for prefix, labels in families:
+        for label in labels:
+            member = prefix + label
+            for name, numerator, denominator, conditions in templates[prefix]:
+                definitions.append((name.format(member),
+                                    numerator.format(member),
+                                    denominator and denominator.format(member),
+                                    [condition.format(member) for condition in conditions]))
+    return definitions
+
+
+def family_columns(prefix, labels):
+    """Names of the counts of a family for the given values"""
+    counts = {family[0]: family[3] for family in FAMILIES}[prefix]
+    return [name.format(prefix + label) for name, _ in counts for label in labels]
+
+
+def rate_columns(columns):
+    """(rate, numerator, denominator) of each rate among the columns of a metrics
+       frame that is a proportion of a count among the columns. The PerPop
+       rates, whose denominator is a population rather than a count of stops,
+       are left out. The numerator may be a count that isn't a column."""
+    columns = list(columns)
+    # Only counts, which all end in Count, are numbers of trials
+    available = {col for col in columns if col.endswith('Count')}
+    definitions = {name: (numerator, denominator)
+                   for name, numerator, denominator, _ in METRICS if denominator}
+    rates = []
+    for col in columns:
+        if col in definitions:
+            numerator, denominator = definitions[col]
+        else:
+            # Family members, named by the member that has a count; a name like
+            # Reason-EquipmentCitationRate matches the shortest member, Equipment
+            members = [(col[:-len(name) + 2], numerator, denominator)
+                       for prefix, _, _, counts, metrics in FAMILIES if col.startswith(prefix)
+                       for name, numerator, denominator, _ in metrics
+                       if denominator and col.endswith(name[2:])
+                       and counts[0][0].format(col[:-len(name) + 2]) in available]
+            if not members:
+                continue
+            member, numerator, denominator = min(members, key=lambda member: len(member[0]))
+            numerator = numerator.format(member)
+            denominator = denominator.format(member)
+        if denominator in available:
+            rates.append((col, numerator, denominator))
+    return rates
+
+
+def evaluate_metrics(counts, definitions):
+    """Metric name -> (values, present) from a table of counts, where values
+       is an array of integer counts or of float rates (NaN where missing) and
+       present shows the groups that have the metric"""
+    metrics = {}
+    for name, numerator, denominator, conditions in definitions:
+        if denominator is None:
+            values = counts[numerator]
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = counts[numerator] / counts[denominator]
+        present = np.ones(len(values), dtype=bool)
+        for condition in conditions:
+            present &= counts[condition] > 0
+        if not np.issubdtype(values.dtype, np.integer):
+            values = np.where(present, values, np.nan)
+        metrics[name] = (values, present)
+    return metrics
+
+
+def _key_codes(values):
+    """Integer codes (-1 for missing) and the values they stand for, in
+       sorted order where the values can be sorted"""
+    if pd.api.types.is_categorical_dtype(values):
+        codes = values.cat.codes.to_numpy().astype(np.int64)
+        categories = values.cat.categories
+        try:
+            order = categories.argsort()
+        except TypeError:
+            return codes, categories
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return np.where(codes >= 0, rank.take(codes), -1), categories.take(order)
+    try:
+        return pd.factorize(values, sort=True)
+    except TypeError:
+        # Values that can't be compared, e.g. a mix of numbers and strings
+        return pd.factorize(values)
+
+
+def _combine_codes(codes_list, sizes):
+    """Sorted group codes for combinations of key codes, and the key codes of
+       each group"""
+    combined = np.zeros(len(codes_list[0]), dtype=np.int64)
+    for codes, size in zip(codes_list, sizes):
+        combined = combined * size + codes
+    group_ids, groups = pd.factorize(combined, sort=True)
+    return group_ids, np.unravel_index(groups, sizes)
+
+
+def rollup(counts, group_keys, sizes, levels):
+    """Sum a table of counts by the finest groups up to coarser groups
+
+    Args:
+        counts (dict): count name -> array with a count per finest group
+        group_keys (list of arrays): key codes of each finest group, where a
+            code equal to the column's size stands for a missing value
+        sizes (list of int): number of values of each key column
+        levels (list of int): positions of the key columns to group by
+
+    Returns:
+        The summed counts and the key codes of each coarser group. Finest groups
+        missing any of the levels' values are left out, like groupby does.
+    """
+    valid = np.logical_and.reduce([group_keys[level] < sizes[level] for level in levels])
+    group_ids, keys = _combine_codes([group_keys[level][valid] for level in levels],
+                                     [sizes[level] for level in levels])
+    n_groups = len(keys[0])
+    summed = {}
+    for name, values in counts.items():
+        summed[name] = np.bincount(group_ids, weights=values[valid],
+                                   minlength=n_groups).astype(values.dtype)
+    return summed, keys
+
+
+def _key_values(uniques, codes):
+    """Values for key codes, where a code equal to the number of values (or
+       -1) stands for a missing value"""
+    return np.append(np.asarray(uniques, dtype=object), np.nan).take(codes)
+
+
+def _sum_duplicates(tables, grouping):
+    """Put tables of counts together, adding up the counts of rows that share
+       a group (a count missing from a table counts as 0 there)"""
+    table = pd.concat(tables, ignore_index=True)
+    if not grouping:
+        group_ids = np.zeros(len(table), dtype=np.int64)
+    else:
+        key_codes = [_key_codes(table[col]) for col in grouping]
+        sizes = [len(uniques) + 1 for _, uniques in key_codes]
+        group_ids, _ = _combine_codes([np.where(codes >= 0, codes, size - 1)
+                                       for (codes, _), size in zip(key_codes, sizes)], sizes)
+    _, first = np.unique(group_ids, return_index=True)
+    summed = table.iloc[first][grouping].reset_index(drop=True)
+    for name in table.columns.drop(grouping):
+        summed[name] = np.bincount(group_ids, weights=table[name].fillna(0).to_numpy(),
+                                   minlength=len(first)).astype(np.int64)
+    return summed
+
+
+def _count_frame(df, grouping, counts, families):
+    """Count the rows of a frame by the grouping columns in this process (see
+       GroupCounts.from_frame)"""
+    plan = CountPlan(df, counts=counts, families=families)
+    key_codes = [_key_codes(df[col]) for col in grouping]
+
+    # Missing values get a code of their own, one past the column's values
+    sizes = [len(uniques) + 1 for _, uniques in key_codes]
+    if grouping:
+        finest_codes = [np.where(codes >= 0, codes, size - 1)
+                        for (codes, _), size in zip(key_codes, sizes)]
+        finest_ids, finest_keys = _combine_codes(finest_codes, sizes)
+        counts = plan.count(finest_ids, len(finest_keys[0]))
+    else:
+        finest_keys = []
+        counts = plan.count(np.zeros(plan.n_rows, dtype=np.int64), 1)
+
+    table = pd.DataFrame({col: _key_values(uniques, codes)
+                          for col, (_, uniques), codes in zip(grouping, key_codes, finest_keys)})
+    table = pd.concat([table, pd.DataFrame(counts)], axis=1)
+    families = [(prefix, labels) for prefix, labels, _ in plan.families]
+    return GroupCounts(grouping, table, list(plan.rows), families)
+
+
+class GroupCounts(object):
+    """Counts of the rows of each group, from which the metrics of any grouping
+    set are made
+
+    Every metric is made from counts, and counts add up: the counts of a
+    coarser group are the sums of the counts of the groups within it, and the
+    counts of two batches of rows are the sums of the counts of each batch. So
+    the data only needs counting once, by every grouping column together, and
+    new rows (e.g. a new year of data) only need counting on their own before
+    being added to the counts so far. Likewise only the counts for the metrics
+    wanted need taking, and others can be taken later and added on.
+
+    Attributes:
+        grouping (list of str): Columns the rows are counted by
+        table (pd.DataFrame): A row for each combination of the grouping
+            columns' values that occurs (missing values included, so those rows
+            still count towards the groupings that don't include that column),
+            with the values followed by a column for each count
+        names (list of str): The counts (from COUNTS) that were taken
+        families (list): (prefix, labels) for each family that was counted, the
+            labels being the values that have counts
+    """
+
+    def __init__(self, grouping, table, names, families):
+        self.grouping = list(grouping)
+        self.table = table
+        self.names = list(names)
+        self.families = families
+
+    @classmethod
+    def from_frame(cls, df, grouping, n_workers=1, counts=None, families=None):
+        """Count the rows of a frame of processed stop data by the grouping
+           columns, taking the given counts and families (see select_counts;
+           default: all)
+
+           With n_workers > 1 the rows are split into that many contiguous
+           partitions, each counted from start to finish (indicators, group
+           codes and counts) in a pool of processes, and the counts added up.
+           Each worker is only sent its partition of the columns that the
+           counts are made from."""
+        if grouping:
+            print('Counting by', tuple(grouping))
+        if not n_workers or n_workers <= 1 or len(df) < n_workers:
+            return _count_frame(df, grouping, counts, families)
+
+        counts, families = _default_selection(counts, families)
+        columns = [col for col in dict.fromkeys(list(grouping) + input_columns(counts, families))
+                   if col in df.columns]
+        bounds = np.linspace(0, len(df), n_workers + 1).astype(int)
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_count_frame, df.iloc[start:stop][columns], grouping,
+                                   counts, families)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            total = futures[0].result()
+            for future in futures[1:]:
+                total = total.add(future.result())
+        return total
+
+    @property
+    def prefixes(self):
+        """Prefixes of the families that were counted"""
+        return [prefix for prefix, _ in self.families]
+
+    def counted(self):
+        """What was counted, as metric names that select_counts takes"""
+        return self.names + self.prefixes
+
+    def uncounted(self, metric_names):
+        """The counts and family prefixes needed for the given metrics that
+           weren't counted (names that aren't metrics are ignored)"""
+        names, prefixes = select_counts(metric_names, errors='ignore')
+        return ([name for name in names if name not in self.names],
+                [prefix for prefix in prefixes if prefix not in self.prefixes])
+
+    def add(self, other):
+        """Counts of the rows counted here together with those counted in other"""
+        if other.grouping != self.grouping:
+            raise ValueError(f'Counts by {other.grouping} can\'t be added to counts by {self.grouping}')
+        if other.names != self.names or other.prefixes != self.prefixes:
+            raise ValueError(f'Counts of {other.counted()} can\'t be added to counts of {self.counted()}')
+
+        # Family values that only one of them has are counted 0 in the other
+        families = []
+        for (prefix, labels), (_, other_labels) in zip(self.families, other.families):
+            families.append((prefix, labels + [label for label in other_labels
+                                               if label not in labels]))
+        return GroupCounts(self.grouping, _sum_duplicates([self.table, other.table], self.grouping),
+                           self.names, families)
+
+    def extend(self, other):
+        """These counts together with the counts in other that weren't taken
+           here, where other counted the same rows (e.g. for metrics that were
+           left out at first)"""
+        if other.grouping != self.grouping:
+            raise ValueError(f'Counts by {other.grouping} can\'t be added to counts by {self.grouping}')
+        names = [name for name in other.names if name not in self.names]
+        families = [(prefix, labels) for prefix, labels in other.families
+                    if prefix not in self.prefixes]
+        columns = self.grouping + names
+        for prefix, labels in families:
+            columns += family_columns(prefix, labels)
+        table = _sum_duplicates([self.table, other.table[columns]], self.grouping)
+
+        # Keep the counts in their usual order
+        names = [name for name, _ in COUNTS if name in self.names + names]
+        order = [prefix for prefix, _, _, _, _ in FAMILIES]
+        families = sorted(self.families + families, key=lambda family: order.index(family[0]))
+        return GroupCounts(self.grouping, table, names, families)
+
+    def _ordered_families(self):
+        """(prefix, labels) of each family, with values ordered by how common
+           they are (like value_counts) and values without rows left out"""
+        counts = {family[0]: family[3] for family in FAMILIES}
+        families = []
+        for prefix, labels in self.families:
+            total_name = counts[prefix][0][0]
+            totals = np.array([self.table[total_name.format(prefix + label)].sum()
+                               for label in labels])
+            order = [i for i in np.argsort(-totals, kind='stable') if totals[i]]
+            families.append((prefix, [labels[i] for i in order]))
+        return families
+
+    def metrics(self, grouping=None, grouping_sets=None, get_population=None,
+                total_population=None):
+        """Calculate the metrics for each grouping set, matching what
+           calc_metrics gives for each group
+
+        Args:
+            grouping (list of str): Columns naming the groups, defaults to the
+                columns counted by (which must include every column of the
+                grouping sets)
+            grouping_sets (list of tuples): Combinations of the grouping columns to
+                calculate, in grouping order, with () for the overall metrics;
+                defaults to every combination
+            get_population (callable): Takes the grouping columns and a frame of
+                the groups' values (a column per grouping column) and gives an
+                array of the groups' populations (NaN if None)
+            total_population (float): Population for the overall metrics
+
+        Returns:
+            A frame with one row per group and a column per metric (Int64 for
+            counts, float for everything else), indexed by the group names of
+            each grouping column (the group's value, or All_<column> for columns
+            it isn't grouped by)
+        """
+        grouping = self.grouping if grouping is None else grouping
+        if grouping_sets is None:
+            grouping_sets = [sub_cats for i in range(1, len(grouping) + 1)
+                             for sub_cats in itertools.combinations(grouping, i)] + [()]
+        uncounted = {col for sub_cats in grouping_sets for col in sub_cats} - set(self.grouping)
+        if uncounted:
+            raise ValueError(f'The rows weren\'t counted by {sorted(uncounted)}')
+
+        # Only the metrics whose counts were taken
+        available = set(self.table.columns) | {'Population', '_HasPopulation'}
+        definitions = [definition for definition in metric_definitions(self._ordered_families())
+                       if all(name in available for name in _metric_inputs(definition))]
+        finest_counts = {name: self.table[name].to_numpy()
+                         for name in self.table.columns.drop(self.grouping)}
+        key_codes = [_key_codes(self.table[col]) for col in self.grouping]
+        sizes = [len(uniques) for _, uniques in key_codes]
+        finest_keys = [np.where(codes >= 0, codes, size)
+                       for (codes, _), size in zip(key_codes, sizes)]
+
+        names = []
+        parts = []
+        for sub_cats in grouping_sets:
+            if sub_cats:
+                print('Grouping by', sub_cats)
+                levels = [self.grouping.index(col) for col in sub_cats]
+                counts, keys = rollup(finest_counts, finest_keys, sizes, levels)
+                values = [key_codes[level][1].take(codes) for level, codes in zip(levels, keys)]
+                groups = list(zip(*values))
+                if get_population is None:
+                    population = np.full(len(groups), np.nan)
+                else:
+                    group_values = pd.DataFrame(dict(zip(sub_cats, values)))
+                    population = np.asarray(get_population(sub_cats, group_values), dtype=float)
+                # NaN counts as a population, like it does in calc_metrics
+                has_population = population != 0
+            else:
+                print('Calculating overall metrics...')
+                counts = {name: values.sum(keepdims=True) for name, values in finest_counts.items()}
+                groups = [()]
+                population = np.array([total_population if total_population else np.nan],
+                                      dtype=float)
+                has_population = np.array([bool(total_population)])
+
+            counts['Population'] = population
+            counts['_HasPopulation'] = has_population
+            parts.append(evaluate_metrics(counts, definitions))
+            for group in groups:
+                lookup = dict(zip(sub_cats, group))
+                names.append(tuple(str(lookup[col]) if col in lookup else 'All_' + col
+                                   for col in grouping))
+
+        data = {}
+        for name, _, _, _ in definitions:
+            if name.startswith('_') or not any(part[name][1].any() for part in parts):
+                continue
+            values = np.concatenate([part[name][0] for part in parts])
+            if np.issubdtype(values.dtype, np.integer):
+                # Nullable integers, so counts stay integers where missing
+                present = np.concatenate([part[name][1] for part in parts])
+                values = pd.arrays.IntegerArray(values.astype(np.int64), ~present)
+            data[name] = values
+
+        return pd.DataFrame(data, index=pd.MultiIndex.from_tuples(names, names=grouping))
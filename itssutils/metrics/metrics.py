@@ -1,9 +1,16 @@
 from collections import defaultdict
+import functools
+import os
 import numpy as np
 import pandas as pd
+from scipy import stats
 import tqdm
 import itertools
 
+from .engine import GroupCounts, FAMILIES, select_counts, input_columns, rate_columns
+from ..loader.cache import read_preprocessed, preprocessed_columns
+from ..loader.load_raw import load_demographic_data
+
 RACE_TRANSLATION = {
     'All_DriverRace': 'total',
     'White': 'not_hispanic_or_latino_white',
@@ -16,6 +23,21 @@ RACE_TRANSLATION = {
     'Pacific': 'not_hispanic_or_latino_native_hawaiian',
 }
 
+# Census row for the metrics that aren't by agency
+STATE_AGENCY = 'ILLINOIS STATE POLICE'
+
+# Ways to calculate metrics by group: all groups at once, or one at a time
+# with calc_metrics
+ENGINES = ['vectorized', 'loop']
+
+# Ways to calculate the confidence intervals of rates: Wilson score intervals,
+# or exact (Clopper-Pearson) intervals, which hold up better for small counts
+INTERVAL_METHODS = ['wilson', 'exact']
+
+# Prefixes of the metric families, with a metric for each value of a column,
+# which are missing for most groups
+FAMILY_PREFIXES = tuple(prefix for prefix, _, _, _, _ in FAMILIES)
+
 
 def calc_metrics(stops_df, population=None):
     """ Huge function to calculate all the metrics we want
@@ -82,7 +104,9 @@ def calc_metrics(stops_df, population=None):
             metrics['OtherSearchContrabandRate'] = other_search_find_count / other_search_count
 
         # Calculate counts and rates for various pullover reasons
+        # Categorical columns count every category, so drop the empty ones
         reason_counts = stops.ReasonForStop.value_counts()
+        reason_counts = reason_counts[reason_counts > 0]
         for (reason, reason_count) in reason_counts.iteritems():
             reasons = stops[stops.ReasonForStop == reason]
             metrics[f'Reason-{reason}Count'] = reason_count
@@ -100,6 +124,7 @@ def calc_metrics(stops_df, population=None):
 
         # Calculate stop outcome counts and rates
         outcome_counts = stops.ResultOfStop.value_counts()
+        outcome_counts = outcome_counts[outcome_counts > 0]
         for (outcome, outcome_count) in outcome_counts.iteritems():
             try:
                 short_outcome = outcome.split()[0]
@@ -138,6 +163,7 @@ def calc_metrics(stops_df, population=None):
 
     if moving_violation_count:
         moving_violation_counts = moving_violations.TypeOfMovingViolation.value_counts()
+        moving_violation_counts = moving_violation_counts[moving_violation_counts > 0]
         for (violation, move_count) in moving_violation_counts.iteritems():
             short_violation = violation.split()[0]
             violation_specific = moving_violations[moving_violations.TypeOfMovingViolation == violation]
@@ -195,10 +221,226 @@ def get_new_tuple_name(names, sublist, full_list):
     return tuple(t)
 
 
-def metrics_by_group(df, grouping, population_csv=None):
+def normalize_agency_names(names):
+    """ Agency names the way the census table is indexed: upper case, without
+        surrounding whitespace """
+    return pd.Index(pd.Series(names, dtype=object).astype(str).str.strip().str.upper())
+
+
+def read_population(population_csv):
+    """Read a population demographic csv (see load_demographic_data), indexed by
+       normalized agency name, with just the population columns"""
+    if not population_csv:
+        return None
+    pop_df = load_demographic_data(population_csv)
+    pop_df.index = normalize_agency_names(pop_df.index)
+    pop_df = pop_df[~pop_df.index.duplicated()]
+    columns = [col for col in dict.fromkeys(RACE_TRANSLATION.values()) if col in pop_df.columns]
+    return pop_df[columns].astype(float)
+
+
+def get_grouping_sets(grouping, grouping_sets=None):
+    """ Normalize grouping sets to a list of tuples of columns in grouping
+        order, where () stands for the overall metrics. Defaults to every
+        combination of the grouping columns followed by the overall metrics. """
+    if grouping_sets is None:
+        return [sub_cats for i in range(1, len(grouping) + 1)
+                for sub_cats in itertools.combinations(grouping, i)] + [()]
+    if not grouping_sets:
+        raise ValueError('Need at least one grouping set')
+    normalized = []
+    for sub_cats in grouping_sets:
+        if isinstance(sub_cats, str):
+            sub_cats = (sub_cats,)
+        unknown = [col for col in sub_cats if col not in grouping]
+        if unknown:
+            raise ValueError(f'Grouping set {sub_cats} has columns {unknown} not in grouping {grouping}')
+        sub_cats = tuple(col for col in grouping if col in sub_cats)
+        if sub_cats not in normalized:
+            normalized.append(sub_cats)
+    return normalized
+
+
+def type_metrics(met_df, grouping):
+    """ Give a metrics frame its types: Int64 counts and float everything else,
+        with the group names in the index only """
+    met_df = met_df.drop(columns=grouping, errors='ignore')
+    for col in met_df.columns:
+        values = pd.to_numeric(met_df[col])
+        met_df[col] = values.astype('Int64') if col.endswith('Count') else values.astype(float)
+    met_df.index = met_df.index.set_names(grouping)
+    return met_df
+
+
+def sparsify(met_df):
+    """ Store the metric families, which are missing for most groups, as sparse
+        float columns """
+    sparse_dtype = pd.SparseDtype(float, np.nan)
+    return met_df.astype({col: sparse_dtype for col in met_df.columns
+                          if col.startswith(FAMILY_PREFIXES)})
+
+
+def as_float(values):
+    """ Metric values as plain floats (NaN where missing), only copying them if
+        they aren't floats already """
+    if isinstance(values.dtype, pd.SparseDtype):
+        values = values.sparse.to_dense()
+    return values.astype(float, copy=False)
+
+
+def binomial_interval(successes, trials, method='wilson', confidence=0.95):
+    """ Lower and upper confidence bounds of the rates successes / trials, for
+        whole arrays of counts at once (NaN where there are no trials, or more
+        successes than trials)
+
+    method: 'wilson' for Wilson score intervals, or 'exact' for Clopper-Pearson
+        intervals
+    confidence: probability that an interval covers the true rate
+    """
+    if method not in INTERVAL_METHODS:
+        raise ValueError(f'Unknown interval method {method}, must be one of {INTERVAL_METHODS}')
+    x = np.asarray(successes, dtype=float)
+    n = np.asarray(trials, dtype=float)
+    alpha = 1 - confidence
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'wilson':
+            z = stats.norm.ppf(1 - alpha / 2)
+            p = x / n
+            center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+            half_width = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+            lower = np.clip(center - half_width, 0, 1)
+            upper = np.clip(center + half_width, 0, 1)
+        else:
+            # The beta quantiles are undefined at the ends, where the bounds are 0 and 1
+            lower = np.where(x > 0, stats.beta.ppf(alpha / 2, x, n - x + 1), 0.)
+            upper = np.where(x < n, stats.beta.ppf(1 - alpha / 2, x + 1, n - x), 1.)
+    missing = ~((n > 0) & (x >= 0) & (x <= n))
+    lower[missing] = np.nan
+    upper[missing] = np.nan
+    return lower, upper
+
+
+def add_confidence_intervals(met_df, method='wilson', confidence=0.95):
+    """ Add the confidence bounds of every rate that's a proportion of counts
+        (see engine.rate_columns) as <rate>Lower and <rate>Upper columns after
+        the rate, all calculated at once from the rates' counts
+
+    Bounds of sparse rates are stored sparse too.
+    """
+    columns = {}
+    for rate, numerator, denominator in rate_columns(met_df.columns):
+        trials = as_float(met_df[denominator]).to_numpy()
+        if numerator in met_df.columns:
+            successes = as_float(met_df[numerator]).to_numpy()
+        else:
+            # Counts like _SearchConsentCount aren't kept, but the rate gives them
+            successes = np.rint(as_float(met_df[rate]).to_numpy() * trials)
+        # Only where the rate is given, like the rate itself
+        trials = np.where(np.isnan(as_float(met_df[rate]).to_numpy()), np.nan, trials)
+        bounds = binomial_interval(successes, trials, method=method, confidence=confidence)
+        for suffix, values in zip(['Lower', 'Upper'], bounds):
+            if isinstance(met_df[rate].dtype, pd.SparseDtype):
+                values = pd.arrays.SparseArray(values, fill_value=np.nan)
+            columns[rate + suffix] = pd.Series(values, index=met_df.index)
+
+    met_df = met_df.drop(columns=list(columns), errors='ignore')
+    order = []
+    for col in met_df.columns:
+        order.append(col)
+        order.extend(name for name in [col + 'Lower', col + 'Upper'] if name in columns)
+    return pd.concat([met_df, pd.DataFrame(columns, index=met_df.index)], axis=1)[order]
+
+
+def get_total_population(pop_df):
+    """ Population for the overall metrics (None without a population) """
+    return None if pop_df is None else get_population(pop_df, (), ())
+
+
+def iter_frames(data, columns=None):
+    """ Frames of processed stop data from a frame, or from an iterable of frames
+        (e.g. chunks from iter_data) or of preprocessed (Feather) partition files,
+        which are read one at a time with only those of the given columns they
+        have (e.g. files without the police dog columns) """
+    if isinstance(data, pd.DataFrame):
+        yield data
+        return
+    for part in data:
+        if isinstance(part, (str, os.PathLike)):
+            wanted = columns
+            if wanted is not None:
+                available = set(preprocessed_columns(part))
+                wanted = [col for col in wanted if col in available]
+            part = read_preprocessed(part, columns=wanted)
+        yield part
+
+
+def count_by_group(df, grouping, grouping_sets=None, n_workers=1, metric_names=None):
+    """ Count the rows of df by the grouping columns that are in some grouping
+        set, giving additive counts (a GroupCounts) that metrics_from_counts
+        makes the metrics from. Counts of different batches of rows, e.g.
+        different years, can be combined with GroupCounts.add.
+
+        df can also be chunks or partitions of the data (see iter_frames). Each
+        is counted on its own and the counts added up as they come, so only one
+        chunk and the counts so far are held in memory at a time.
+
+        With metric_names (metric names, or family prefixes like 'Reason-'),
+        only the counts those metrics need are taken. """
+    if isinstance(grouping, str):
+        grouping = [grouping]
+    grouping_sets = get_grouping_sets(grouping, grouping_sets)
+    counted = [col for col in grouping if any(col in sub_cats for sub_cats in grouping_sets)]
+    counts, families = select_counts(metric_names)
+    columns = list(dict.fromkeys(counted + input_columns(counts, families)))
+
+    total = None
+    for frame in iter_frames(df, columns=columns):
+        frame_counts = GroupCounts.from_frame(frame, counted, n_workers=n_workers,
+                                              counts=counts, families=families)
+        total = frame_counts if total is None else total.add(frame_counts)
+    if total is None:
+        raise ValueError('There is no data to count')
+    return total
+
+
+def metrics_from_counts(counts, grouping, population_csv=None, grouping_sets=None,
+                        sparse=False):
+    """ Calculate the metrics by group from counts made by count_by_group,
+        giving the same frame as metrics_by_group """
+    if isinstance(grouping, str):
+        grouping = [grouping]
+    grouping_sets = get_grouping_sets(grouping, grouping_sets)
+    pop_df = read_population(population_csv)
+    lookup = None if pop_df is None else functools.partial(get_populations, pop_df)
+    met_df = counts.metrics(grouping, grouping_sets=grouping_sets, get_population=lookup,
+                            total_population=get_total_population(pop_df))
+    return sparsify(met_df) if sparse else met_df
+
+
+def metrics_by_group(df, grouping, population_csv=None, engine='vectorized',
+                     grouping_sets=None, n_workers=1, sparse=False, metric_names=None):
     """ Allow grouping by multiple columns, e.g. race and sex
 
+    df: processed stop data, or chunks or partitions of it (vectorized engine
+        only): an iterable of frames, e.g. from iter_data, or of the filenames
+        of preprocessed Feather files
     grouping: str or list of str
+    engine: 'vectorized' counts every group at once (see engine.py), 'loop'
+        runs calc_metrics on each group in turn; the results are the same
+    grouping_sets: combinations of grouping columns to calculate (a list of
+        tuples of columns, with () for the overall metrics); by default every
+        combination is calculated, along with the overall metrics
+    n_workers: number of processes to count with (vectorized engine only),
+        each of which is sent only its own partition of the rows
+    sparse: store the metric families (Reason-, Result- and move- metrics) as
+        sparse columns, since most groups don't have most of them
+    metric_names: only calculate these metrics, along with any others that
+        come from the same counts (vectorized engine only); a family's prefix,
+        e.g. 'Reason-', stands for every metric in the family
+
+    The metrics come back indexed by the group names for each grouping column,
+    with Int64 counts and float rates (use as_float to get plain floats of any
+    metric).
 
     examples:
     # Calculate the metrics for each racial group across all traffic stops
@@ -206,64 +448,104 @@ def metrics_by_group(df, grouping, population_csv=None):
 
     # Calculate yearly metrics by driver sex for each agency
     mdf = metrics_by_group(raw_data_df, ['AgencyName', 'Year', 'DriverSex'])
+
+    # Only calculate metrics by agency and race, and by race alone
+    mdf = metrics_by_group(raw_data_df, ['AgencyName', 'DriverRace'],
+                           grouping_sets=[('AgencyName', 'DriverRace'), ('DriverRace',)])
+
+    # Just the search rates (and what else comes from stop and search counts)
+    mdf = metrics_by_group(raw_data_df, ['AgencyName', 'DriverRace'], metric_names=['SearchRate'])
+
+    # Stream a year of data a million rows at a time
+    mdf = metrics_by_group(iter_data(2017, '2017_ITSS_Data.txt', chunksize=1000000),
+                           ['AgencyName', 'DriverRace'])
     """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown engine {engine}, must be one of {ENGINES}')
+    if n_workers and n_workers > 1 and engine != 'vectorized':
+        raise ValueError('n_workers is only supported by the vectorized engine')
+    if metric_names is not None and engine != 'vectorized':
+        raise ValueError('metric_names is only supported by the vectorized engine')
+    if not isinstance(df, pd.DataFrame) and engine != 'vectorized':
+        raise ValueError('Chunks and partitions are only supported by the vectorized engine')
     if isinstance(grouping, str):
         grouping = [grouping]
+    grouping_sets = get_grouping_sets(grouping, grouping_sets)
+
+    if engine == 'vectorized':
+        counts = count_by_group(df, grouping, grouping_sets=grouping_sets, n_workers=n_workers,
+                                metric_names=metric_names)
+        met_df = metrics_from_counts(counts, grouping, population_csv=population_csv,
+                                     grouping_sets=grouping_sets, sparse=sparse)
+        print('Done!')
+        return met_df
+
+    pop_df = read_population(population_csv)
+    total_population = get_total_population(pop_df)
     metric_data = {}
-    pop_df = None
-    if population_csv:
-        pop_df = pd.read_csv(population_csv)
-        pop_df = pop_df.set_index('agency_name')
 
     # Make the aggregate tuples and groupings
-    for i in range(1, len(grouping) + 1):
-        for sub_cats in itertools.combinations(grouping, i):
-            print('Grouping by', sub_cats)
-            for group_name_tup, group_df in tqdm.tqdm(df.groupby(list(sub_cats))):
-                population = get_population(pop_df, sub_cats, group_name_tup)
-                metrics = calc_metrics(group_df, population=population)
-                # Make a new list with the name replaced with "all" in the correct order
-                new_name = get_new_tuple_name(group_name_tup, sub_cats, grouping)
-                for (group_col_name, group_name) in zip(grouping, new_name):
-                    metrics[group_col_name] = group_name
-                metric_data[new_name] = metrics
-
-    print('Calculating overall metrics...')
-    total_population = None if not pop_df else pop_df.loc['ILLINOIS STATE POLICE', 'total']
-    all_metrics = calc_metrics(df, population=total_population)
-    for name in grouping:
-        all_metrics[name] = 'All_' + name
-    all_tup = tuple(['All_' + g for g in grouping])
-    metric_data[all_tup] = all_metrics
-
-    met_df = pd.DataFrame(metric_data).T
+    for sub_cats in grouping_sets:
+        if not sub_cats:
+            print('Calculating overall metrics...')
+            all_metrics = calc_metrics(df, population=total_population)
+            for name in grouping:
+                all_metrics[name] = 'All_' + name
+            all_tup = tuple(['All_' + g for g in grouping])
+            metric_data[all_tup] = all_metrics
+            continue
+
+        print('Grouping by', sub_cats)
+        for group_name_tup, group_df in tqdm.tqdm(df.groupby(list(sub_cats), observed=True)):
+            population = get_population(pop_df, sub_cats, group_name_tup)
+            metrics = calc_metrics(group_df, population=population)
+            # Make a new list with the name replaced with "all" in the correct order
+            new_name = get_new_tuple_name(group_name_tup, sub_cats, grouping)
+            for (group_col_name, group_name) in zip(grouping, new_name):
+                metrics[group_col_name] = group_name
+            metric_data[new_name] = metrics
+
+    met_df = type_metrics(pd.DataFrame(metric_data).T, grouping)
+    if sparse:
+        met_df = sparsify(met_df)
 
     print('Done!')
     return met_df
 
 
-def get_population(pop_df, grouping, group):
-    # If we don't have a population dataframe, just return NaN
-    if not pop_df:
-        return np.NaN
+def get_populations(pop_df, grouping, groups):
+    """ Population of each group, joining the groups to the census table
+
+    pop_df: population table from read_population (None for no population)
+    grouping: the columns the groups are grouped by
+    groups: frame with the values of each group in a column per grouping column
+
+    Groups not grouped by agency get the population of the state, and groups
+    not grouped by race the total population. A group whose agency or race the
+    census doesn't have gets NaN.
+    """
+    if pop_df is None:
+        return np.full(len(groups), np.nan)
 
+    if 'AgencyName' in grouping:
+        agencies = normalize_agency_names(groups['AgencyName'])
+    else:
+        agencies = [STATE_AGENCY] * len(groups)
+    if 'DriverRace' in grouping:
+        columns = [RACE_TRANSLATION.get(race) for race in groups['DriverRace']]
+    else:
+        columns = [RACE_TRANSLATION['All_DriverRace']] * len(groups)
+
+    rows = pop_df.index.get_indexer(agencies)
+    cols = pop_df.columns.get_indexer(columns)
+    found = (rows >= 0) & (cols >= 0)
+    values = pop_df.to_numpy()[rows, cols]
+    return np.where(found, values, np.nan)
+
+
+def get_population(pop_df, grouping, group):
+    """ Population of a single group (see get_populations) """
     if not isinstance(group, tuple):
         group = (group, )
-    # Try to get the population but return the population of Illinois as a default
-    try:
-        name_index = grouping.index('AgencyName')
-        ret = pop_df.loc[group[name_index].upper()]
-    except ValueError:
-        ret = pop_df.loc['ILLINOIS STATE POLICE']
-    except KeyError:
-        return np.NaN
-
-    # Translate between the Census race categories and the ITSS Form race categories
-    try:
-        race_index = grouping.index('DriverRace')
-        translation = RACE_TRANSLATION[group[race_index]]
-        ret = ret[translation]
-    except ValueError:
-        translation = RACE_TRANSLATION['All_DriverRace']
-        ret = ret[translation]
-    return ret
+    groups = pd.DataFrame([group], columns=list(grouping))
+    return get_populations(pop_df, grouping, groups)[0]
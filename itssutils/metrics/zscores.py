@@ -1,20 +1,36 @@
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
 from tqdm import tqdm
 
+from .metrics import as_float
+
+def _float_array(values):
+    """ Counts as a float array, with NaN where missing """
+    if isinstance(values, (pd.Series, pd.Index)):
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    return np.asarray(values, dtype=float)
+
+def calculate_zscores(N_1, x_1, N_2, x_2):
+    """ Calculate z-scores for the differences between rates x_1 / N_1 and
+        x_2 / N_2, elementwise over arrays of counts
+
+        This is the pooled two-proportion z-test (statsmodels'
+        proportions_ztest), giving NaN where a count is missing, x > N, there
+        are fewer than 5 events or non-events, or the z-score isn't finite """
+    N_1, x_1, N_2, x_2 = (_float_array(values) for values in (N_1, x_1, N_2, x_2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pooled = (x_1 + x_2) / (N_1 + N_2)
+        z = (x_1 / N_1 - x_2 / N_2) / np.sqrt(pooled * (1 - pooled) * (1 / N_1 + 1 / N_2))
+    # Comparisons with NaN are False, so missing counts fail these too
+    valid = ((x_1 <= N_1) & (x_2 <= N_2)
+             & (x_1 >= 5) & (x_2 >= 5)
+             & (N_1 - x_1 >= 5) & (N_2 - x_2 >= 5)
+             & np.isfinite(z))
+    return np.where(valid, z, np.nan)
+
 def calculate_zscore(N_1, x_1, N_2, x_2):
     """ Calculate a z-score for a difference between rates """
-    xs = np.array([x_1, x_2])
-    Ns = np.array([N_1, N_2])
-    if any(np.isnan(xs + Ns)) or any (xs > Ns):
-        return np.NaN
-    elif any(xs < 5) or any(Ns-xs < 5):
-        return np.NaN
-    z, p = sm.stats.proportions_ztest(xs, Ns)
-    if not np.isfinite(z):
-        return np.NaN
-    return z
+    return calculate_zscores(N_1, x_1, N_2, x_2)[()]
 
 def safe_divide(num, den):
     try:
@@ -23,7 +39,7 @@ def safe_divide(num, den):
         return np.NaN
 
 def get_rate_df_for(df, focus, num_col, den_col):
-    rdf = df.loc[focus].loc[:, [num_col, den_col]]
+    rdf = df.loc[focus].loc[:, [num_col, den_col]].apply(as_float)
     rdf['Rate'] = safe_divide(rdf[num_col], rdf[den_col])
     rdf.columns = ['_'.join([col, str(focus)]) for col in rdf.columns]
     return rdf
@@ -47,9 +63,91 @@ def get_zscore_df(df, target, reference, x_col, N_col,
     tgt_df = tgt_df.loc[shared_index]
     rdf = ref_df.loc[shared_index]
     tdf = pd.concat([tgt_df, ref_df], axis=1, sort=False)
-    zscores = tdf.apply(lambda x: calculate_zscore(x[min_names[1]], x[min_names[0]], \
-                                                    x[ref_names[1]], x[ref_names[0]]),
-                                                    axis=1)
-    zscores.name = '_'.join([x_col, N_col, newcol_suffix])
+    zscores = pd.Series(calculate_zscores(tdf[min_names[1]], tdf[min_names[0]],
+                                          tdf[ref_names[1]], tdf[ref_names[0]]),
+                        index=tdf.index,
+                        name='_'.join([x_col, N_col, newcol_suffix]))
 
     return zscores
+
+# (event count, observation count) pairs compared by default, where the
+# metrics have them
+DEFAULT_PAIRS = [('SearchCount', 'StopCount'),
+                 ('SearchHitCount', 'SearchCount'),
+                 ('StopHitCount', 'StopCount'),
+                 ('SearchRequestCount', 'StopCount'),
+                 ('ConsentGivenCount', 'SearchRequestCount'),
+                 ('Result-CitationCount', 'StopCount'),
+                 ('DogSniffCount', 'StopCount')]
+
+def _integer_counts(values):
+    """ Float counts as nullable integers """
+    return pd.array(values, dtype='Int64')
+
+def get_zscore_table(df, reference, pairs=None, level=None, targets=None):
+    """ Calculate the z-scores of every target group's rates against the
+        reference group's, for every pair of event and observation counts, in
+        one pass over a metrics frame (no re-slicing per target or pair)
+
+        df: metrics frame, indexed by the group names of each grouping column
+        reference: the group to compare to, e.g. 'White'
+        pairs: list of (event count, observation count) columns, e.g.
+            ('SearchCount', 'StopCount'); defaults to the DEFAULT_PAIRS df has
+        level: index level the reference is in (default: the first one it's in)
+        targets: groups in that level to compare (default: all of them but the
+            reference and All_<level>)
+
+        Returns a tidy frame with a row for each group of the other levels (e.g.
+        each agency) that has a reference row, target and pair: the other
+        levels' names, the target, the event and observation columns, both
+        groups' counts and rates, and the z-score """
+    names = [name if name is not None else f'level_{i}' for i, name in enumerate(df.index.names)]
+    index = df.index.set_names(names)
+    if level is None:
+        level = next((name for name in names if reference in index.get_level_values(name)), None)
+        if level is None:
+            raise KeyError(f'Reference {reference} not in index.')
+    if pairs is None:
+        pairs = [(x_col, N_col) for x_col, N_col in DEFAULT_PAIRS
+                 if x_col in df.columns and N_col in df.columns]
+    values = index.get_level_values(level)
+    if targets is None:
+        targets = [value for value in values.unique() if value not in (reference, f'All_{level}')]
+
+    # Match every row to the reference row for the same groups of the other levels
+    others = [name for name in names if name != level]
+    is_reference = np.asarray(values == reference)
+    reference_rows = np.flatnonzero(is_reference)
+    if others:
+        keys = index.droplevel(level)
+        matches = keys[is_reference].get_indexer(keys)
+    else:
+        matches = np.zeros(len(df), dtype=int) if len(reference_rows) else np.full(len(df), -1)
+    rows = np.flatnonzero(np.asarray(values.isin(targets)) & (matches >= 0))
+    reference_rows = reference_rows[matches[rows]]
+
+    groups = index[rows].to_frame(index=False)[others + [level]]
+    columns = {col: _float_array(df[col]) for pair in pairs for col in pair}
+    tables = []
+    for x_col, N_col in pairs:
+        x_1, N_1 = columns[x_col][rows], columns[N_col][rows]
+        x_2, N_2 = columns[x_col][reference_rows], columns[N_col][reference_rows]
+        table = groups.copy()
+        table['Event'] = x_col
+        table['Observation'] = N_col
+        table['EventCount'] = _integer_counts(x_1)
+        table['ObservationCount'] = _integer_counts(N_1)
+        table['ReferenceEventCount'] = _integer_counts(x_2)
+        table['ReferenceObservationCount'] = _integer_counts(N_2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table['Rate'] = np.where(N_1 > 0, x_1 / N_1, np.nan)
+            table['ReferenceRate'] = np.where(N_2 > 0, x_2 / N_2, np.nan)
+        table['ZScore'] = calculate_zscores(N_1, x_1, N_2, x_2)
+        tables.append(table)
+
+    if not tables:
+        raise ValueError('No event and observation count pairs to compare')
+    zdf = pd.concat(tables, ignore_index=True)
+    zdf['Event'] = zdf['Event'].astype('category')
+    zdf['Observation'] = zdf['Observation'].astype('category')
+    return zdf
@@ -1,10 +1,12 @@
 import pathlib
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.ticker import ScalarFormatter
 
 from .plot_config import PlotConfig
 from ..metrics.names import MetricNames
+from ..metrics.metrics import as_float
 
 
 def format_axes(ax, ind, xname, xax_label=None):
@@ -26,14 +28,24 @@ def format_axes(ax, ind, xname, xax_label=None):
     plt.tight_layout(rect=[0.05, 0.03, 0.95, 0.95])
 
 
+def get_bounds(df, ind, value_col, y_data):
+    """ Lower and upper confidence bounds of value_col for the bars in y_data,
+        or None if the metrics don't have them """
+    if value_col + 'Lower' not in df.columns or value_col + 'Upper' not in df.columns:
+        return None
+    return [as_float(df.loc[ind, value_col + suffix]).reindex(y_data.index)
+            for suffix in ['Lower', 'Upper']]
+
+
 def make_barplot(df, ind, value_col, only_include=None, title=None,
             savename=None, savecsv=False,
-            xax_label=None):
-    """make a barplot"""
+            xax_label=None, intervals=True):
+    """make a barplot, with error bars for the confidence intervals if the metrics
+       have them (and intervals)"""
     config = PlotConfig()
 
     # Get the x and y data, matched on the index
-    y_data = df.loc[ind, value_col].astype(float)
+    y_data = as_float(df.loc[ind, value_col])
     if value_col.endswith('PerPop'):
         y_data = y_data * 1000
     if y_data.isnull().all():
@@ -41,6 +53,7 @@ def make_barplot(df, ind, value_col, only_include=None, title=None,
         return
     if only_include:
         y_data = y_data.reindex(reversed(only_include))
+    bounds = get_bounds(df, ind, value_col, y_data) if intervals else None
 
     fig, ax = plt.subplots(figsize=(9,6))
     colors = [config.get_color(ind) for ind in y_data.index]
@@ -49,13 +62,22 @@ def make_barplot(df, ind, value_col, only_include=None, title=None,
     idx = as_list.index('Hispanic/Latino')
     as_list[idx] = 'Latinx'
     y_data.index = as_list
+    if bounds is not None:
+        bounds = [bound.set_axis(as_list) for bound in bounds]
 
-    y_data.plot.barh(ax=ax, color=colors, alpha=1, zorder=2)
-    max_width = y_data[np.isfinite(y_data)].max()
+    xerr = None
+    # Where the bars (or their error bars) end, to label them past it
+    ends = y_data.values
+    if bounds is not None:
+        lower, upper = [bound.values for bound in bounds]
+        xerr = np.array([y_data.values - lower, upper - y_data.values])
+        ends = np.fmax(ends, upper)
+    y_data.plot.barh(ax=ax, color=colors, alpha=1, zorder=2, xerr=xerr, ecolor='gray', capsize=3)
+    max_width = ends[np.isfinite(ends)].max()
     if 'Rate' in value_col:
-        for (i, p) in zip(y_data.index, ax.patches):
+        for (i, p, end) in zip(y_data.index, ax.patches, ends):
             if np.isfinite(y_data.loc[i]):
-                ax.text(p.get_width()+max_width/100, p.get_y()+0.21, '{:0.1f}%'.format(y_data.loc[i] * 100),
+                ax.text(end+max_width/100, p.get_y()+0.21, '{:0.1f}%'.format(y_data.loc[i] * 100),
                     fontsize=10)
     else:
         for (i, p) in zip(y_data.index, ax.patches):
@@ -80,7 +102,11 @@ def make_barplot(df, ind, value_col, only_include=None, title=None,
         plt.close('all')
         if savecsv:
             csv_savename = pathlib.Path(savename)
-            y_data.to_csv(str(csv_savename.with_suffix('.csv')))
+            save_data = y_data
+            if bounds is not None:
+                save_data = pd.concat([y_data] + bounds, axis=1,
+                                      keys=[value_col, value_col + 'Lower', value_col + 'Upper'])
+            save_data.to_csv(str(csv_savename.with_suffix('.csv')))
     else:
         plt.show()
 
@@ -7,7 +7,8 @@ from textwrap import fill
 
 from .plot_config import PlotConfig
 from ..metrics.names import MetricNames
-from ..metrics.zscores import calculate_zscore
+from ..metrics.metrics import as_float
+from ..metrics.zscores import calculate_zscores
 
 
 def format_axes(ax, logscaling, limits):
@@ -64,10 +65,10 @@ def make_ratioplot(df, x_index, y_index, value_col, size_col,
     full_x_data = df.loc[x_index]
     full_y_data = df.loc[y_index]
     shared_indices = full_x_data.index.intersection(full_y_data.index)\
-                        .drop('All_AgencyName')
+                        .drop('All_AgencyName', errors='ignore')
 
-    x_data = full_x_data.loc[shared_indices, value_col].astype(float)
-    y_data = full_y_data.loc[shared_indices, value_col].astype(float)
+    x_data = as_float(full_x_data.loc[shared_indices, value_col])
+    y_data = as_float(full_y_data.loc[shared_indices, value_col])
     ratio = y_data / x_data
     # if not logscaling:
     ratio[ratio < 1] = -1 / ratio[ratio < 1] + 2
@@ -79,19 +80,20 @@ def make_ratioplot(df, x_index, y_index, value_col, size_col,
         scale_factor = 1000.0 if not scale_factor else scale_factor
         save_data = pd.concat([x_data, y_data, ratio], axis=1)
     except:
-        x_sizes = full_x_data.loc[shared_indices, size_col].astype(float)
-        sizes = full_y_data.loc[shared_indices, size_col].astype(float)
+        x_sizes = as_float(full_x_data.loc[shared_indices, size_col])
+        sizes = as_float(full_y_data.loc[shared_indices, size_col])
         scale_factor = df[size_col].max() if not scale_factor else scale_factor
         save_data = pd.concat([x_data, y_data, ratio, x_sizes, sizes], axis=1)
 
     alphas = None
     if population_col:
-        x_pop_data = full_x_data.loc[shared_indices, population_col].astype(float)
-        y_pop_data = full_y_data.loc[shared_indices, population_col].astype(float)
+        x_pop_data = as_float(full_x_data.loc[shared_indices, population_col])
+        y_pop_data = as_float(full_y_data.loc[shared_indices, population_col])
         full_data = pd.concat([x_pop_data, x_sizes, y_pop_data, sizes], axis=1)
         full_data.columns = ['N_1', 'x_1', 'N_2', 'x_2']
-        zscores = full_data.apply(lambda x: calculate_zscore(x['N_1'], x['x_1'], x['N_2'], x['x_2']),
-                                    axis=1).abs().fillna(0)
+        zscores = pd.Series(calculate_zscores(full_data['N_1'], full_data['x_1'],
+                                              full_data['N_2'], full_data['x_2']),
+                            index=full_data.index).abs().fillna(0)
         if z_opacity == 'gradient':
             alphas = zscores.clip(upper=z_threshold).values / (z_threshold + 1) + 0.1
         elif z_opacity == 'filter':
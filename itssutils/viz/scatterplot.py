@@ -7,7 +7,8 @@ from textwrap import fill
 
 from itssutils.viz.plot_config import PlotConfig
 from ..metrics.names import MetricNames
-from ..metrics.zscores import calculate_zscore
+from ..metrics.metrics import as_float
+from ..metrics.zscores import calculate_zscores
 
 
 def format_scatterplot_axes(ax, logscaling, limits):
@@ -115,9 +116,9 @@ def make_scatterplot(df, x_index, y_index, value_col, size_col,
     # Get the x and y data, matched on the index
     full_x_data = df.loc[x_index]
     full_y_data = df.loc[y_index]
-    shared_indices = full_x_data.index.intersection(full_y_data.index).drop('All_AgencyName')
+    shared_indices = full_x_data.index.intersection(full_y_data.index).drop('All_AgencyName', errors='ignore')
     full_index = full_x_data.index.union(full_y_data.index)
-    x_data = full_x_data.loc[shared_indices, value_col].astype(float)
+    x_data = as_float(full_x_data.loc[shared_indices, value_col])
     if isinstance(x_index, tuple):
         x_index_name = ' '.join(x_index)
         y_index_name = ' '.join(y_index)
@@ -125,7 +126,7 @@ def make_scatterplot(df, x_index, y_index, value_col, size_col,
         x_index_name = x_index
         y_index_name = y_index
     x_data.name = x_index_name + ' ' + x_data.name
-    y_data = full_y_data.loc[shared_indices, value_col].astype(float)
+    y_data = as_float(full_y_data.loc[shared_indices, value_col])
     y_data.name = y_index_name + ' ' + y_data.name
 
     if as_ratio:
@@ -144,24 +145,24 @@ def make_scatterplot(df, x_index, y_index, value_col, size_col,
         counts = float(size_col)
         scale_factor = 1000.0 if not scale_factor else scale_factor
     except:
-        x_counts = full_x_data.loc[shared_indices, size_col].astype(float)
+        x_counts = as_float(full_x_data.loc[shared_indices, size_col])
         x_counts.name = x_index_name + ' ' + size_col
-        counts = full_y_data.loc[shared_indices, size_col].astype(float)
+        counts = as_float(full_y_data.loc[shared_indices, size_col])
         counts.name = y_index_name + ' ' + size_col
         scale_factor = df[size_col].max() if not scale_factor else scale_factor
 
     alphas = None
     if population_col:
-        x_pop_data = full_x_data.loc[shared_indices, population_col].astype(float)
+        x_pop_data = as_float(full_x_data.loc[shared_indices, population_col])
         x_pop_data.name = x_index_name + ' ' + population_col
-        y_pop_data = full_y_data.loc[shared_indices, population_col].astype(float)
+        y_pop_data = as_float(full_y_data.loc[shared_indices, population_col])
         y_pop_data.name = y_index_name + ' ' + population_col
         full_data = pd.concat([x_pop_data, x_counts, y_pop_data, counts], axis=1)
         old_cols = full_data.columns
         full_data.columns = ['N_1', 'x_1', 'N_2', 'x_2']
-        raw_zscores = full_data.apply(lambda x: calculate_zscore(x['N_2'], x['x_2'], x['N_1'], x['x_1']),
-                                    axis=1)
-        raw_zscores.name = 'Zscore'
+        raw_zscores = pd.Series(calculate_zscores(full_data['N_2'], full_data['x_2'],
+                                                  full_data['N_1'], full_data['x_1']),
+                                index=full_data.index, name='Zscore')
         zscores = raw_zscores.abs().fillna(0)
         if z_opacity == 'gradient':
             alphas = zscores.clip(upper=z_threshold).values / (z_threshold + 1) + 0.1
@@ -3,6 +3,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from itssutils.viz.plot_config import PlotConfig
 from ..metrics.names import MetricNames
+from ..metrics.metrics import as_float
 
 
 def metrics_timeseries(met, col,
@@ -11,9 +12,11 @@ def metrics_timeseries(met, col,
                        title='',
                        ylabel=None,
                        savename=None,
-                       savecsv=None):
+                       savecsv=None,
+                       intervals=True):
     """ Pass in a DF with 'year' as the last index, plots the other top-level
-        indices over time for col """
+        indices over time for col, shading the confidence intervals if the
+        metrics have them (and intervals) """
     config = PlotConfig()
     fig, ax = plt.subplots(figsize=(9,6))
     if only_include_rows:
@@ -21,17 +24,25 @@ def metrics_timeseries(met, col,
     else:
         met = met.loc["All_AgencyName"]
     nblevels = met.index.nlevels
+    bound_cols = [col + 'Lower', col + 'Upper']
+    intervals = intervals and all(bound in met.columns for bound in bound_cols)
     savedata = []
     for name, df in met.groupby(level=list(range(nblevels-1))):
         if only_include_entries and name not in only_include_entries:
             continue
         old_label = name
-        tdf = df.loc[name, col].drop(['All_Year'], axis=0)
+        tdf = as_float(df.loc[name, col]).drop(['All_Year'], axis=0, errors='ignore')
         if name == 'Hispanic/Latino':
             name = 'Latinx'
         ax.plot(tdf.index, tdf.values, 'o-', label=name, color=config.get_color(old_label))
         tdf.name = name
         savedata.append(tdf)
+        if intervals:
+            lower, upper = [as_float(df.loc[old_label, bound]).reindex(tdf.index)
+                            for bound in bound_cols]
+            ax.fill_between(tdf.index, lower.values, upper.values, alpha=0.2,
+                            color=config.get_color(old_label))
+            savedata.extend([lower.rename(f'{name}Lower'), upper.rename(f'{name}Upper')])
 
     metric_names = MetricNames()
     ax.legend(bbox_to_anchor=(1,1))
@@ -18,7 +18,7 @@ def plot_zhist(zscore_df, focus, title='Z-Score Histogram',
     """ Plot a single z-score histogram """
     config = PlotConfig()
     fig, ax = plt.subplots(figsize=(6,6))
-    hdf = zscore_df.drop('All_AgencyName')
+    hdf = zscore_df.drop('All_AgencyName', errors='ignore')
     total = hdf.notnull().sum()
     bins = np.arange(-bound-bin_size, bound+bin_size, bin_size)
     hdf.clip(-clip, clip).hist(ax=ax, bins=bins, alpha=0.8, label=str(focus),
@@ -26,5 +26,6 @@ setup(
         "matplotlib",
         "tqdm",
         "statsmodels",
+        "pyarrow",
     ],
 )